@@ -3,3 +3,6 @@ from django.apps import AppConfig
 
 class DaseinerConfig(AppConfig):
     name = 'daseiner'
+
+    def ready(self):
+        from . import signals
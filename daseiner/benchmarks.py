@@ -0,0 +1,320 @@
+import asyncio
+import json
+import threading
+import time
+import uuid
+from channels.routing import URLRouter
+from channels.testing import WebsocketCommunicator
+from django.contrib.auth.models import User
+from django.db import connections
+from django.db.backends.signals import connection_created
+from channels.db import database_sync_to_async
+from .models import Question, JUDGE_CONNECTION_LIMIT
+from .routing import websocket_urlpatterns
+from . import session_state
+from .consumers import ParticipantChatConsumer
+from .frames import group_event
+
+IN_MEMORY_CHANNEL_LAYERS = {'default': {'BACKEND': 'channels.layers.InMemoryChannelLayer'}}
+
+
+def percentile(values, pct):
+    if not values:
+        return None
+    ordered = sorted(values)
+    index = max(int(round(pct / 100.0 * len(ordered))) - 1, 0)
+    return ordered[min(index, len(ordered) - 1)]
+
+
+class QueryCounter:
+    # Counts queries on every connection, including the ones opened by the
+    # database_sync_to_async worker threads.
+
+    def __init__(self):
+        self.count = 0
+        self.lock = threading.Lock()
+
+    def __call__(self, execute, sql, params, many, context):
+        with self.lock:
+            self.count += 1
+        return execute(sql, params, many, context)
+
+    def install(self):
+        connection_created.connect(self.connection_created)
+        for connection in connections.all():
+            self.attach(connection)
+
+    def uninstall(self):
+        connection_created.disconnect(self.connection_created)
+
+    def connection_created(self, sender, connection, **kwargs):
+        self.attach(connection)
+
+    def attach(self, connection):
+        if self not in connection.execute_wrappers:
+            connection.execute_wrappers.append(self)
+
+
+class ScopeUser:
+    # Stands in for TokenAuthMiddleware: consumers await scope['user'].
+
+    def __init__(self, inner, user):
+        self.inner = inner
+        self.user = user
+
+    def __call__(self, scope):
+        async def resolve_user():
+            return self.user
+        return self.inner(dict(scope, user=resolve_user()))
+
+
+class ConsumerBenchmark:
+    def __init__(self, rooms=10, judges_per_room=2, messages_per_room=20, judge_messages_per_room=5,
+                 message_rate=10.0, timeout=10):
+        # Judges past the room limit would sit in the queue until timeout.
+        if judges_per_room > JUDGE_CONNECTION_LIMIT:
+            raise ValueError(f"A room seats at most {JUDGE_CONNECTION_LIMIT} judges")
+        self.rooms = rooms
+        self.judges_per_room = judges_per_room
+        self.messages_per_room = messages_per_room
+        self.judge_messages_per_room = judge_messages_per_room if judges_per_room else 0
+        self.message_rate = message_rate
+        self.timeout = timeout
+        self.queries = QueryCounter()
+        self.application = URLRouter(websocket_urlpatterns)
+
+    def create_users(self):
+        run_id = uuid.uuid4().hex[:8]
+        if not Question.objects.exists():
+            Question.objects.create(title="Benchmark motion")
+        participants = [
+            User.objects.create_user(username=f"bench-{run_id}-p{i}", password="benchmark")
+            for i in range(self.rooms * 2)
+        ]
+        judges = [
+            User.objects.create_user(username=f"bench-{run_id}-j{i}", password="benchmark")
+            for i in range(self.rooms * self.judges_per_room)
+        ]
+        return participants, judges
+
+    async def open(self, user, path):
+        communicator = WebsocketCommunicator(ScopeUser(self.application, user), path)
+        connected, _ = await communicator.connect(timeout=self.timeout)
+        if not connected:
+            raise RuntimeError(f"Could not connect to {path}")
+        return communicator
+
+    def room_id_from(self, frame):
+        frame = json.loads(frame)
+        return frame['roomId'] if isinstance(frame, dict) else frame
+
+    async def pair(self, first, second):
+        first_socket = await self.open(first, f"ws/participant-match/{uuid.uuid4()}/")
+        second_socket = await self.open(second, f"ws/participant-match/{uuid.uuid4()}/")
+        await first_socket.send_json_to({'command': 'find_match'})
+        await self.wait_until_queued(first)
+        await second_socket.send_json_to({'command': 'find_match'})
+        first_room = self.room_id_from(await first_socket.receive_from(timeout=self.timeout))
+        second_room = self.room_id_from(await second_socket.receive_from(timeout=self.timeout))
+        await first_socket.disconnect()
+        await second_socket.disconnect()
+        return [(first, first_room), (second, second_room)]
+
+    async def wait_until_queued(self, user):
+        # The first participant gets no frame until paired, so watch their
+        # session state instead.
+        deadline = time.perf_counter() + self.timeout
+        while time.perf_counter() < deadline:
+            state = await database_sync_to_async(session_state.get_state)(user.id)
+            if state['state'] == session_state.QUEUED:
+                return
+            await asyncio.sleep(0.001)
+        raise RuntimeError(f"{user.username} was never queued")
+
+    async def run_pairs(self, pairs):
+        # Pairs run one after another so every searcher is matched with its
+        # intended partner and no two searchers open rooms side by side.
+        return [await self.pair(first, second) for first, second in pairs]
+
+    async def judge(self, user):
+        socket = await self.open(user, f"ws/judge-match/{uuid.uuid4()}/")
+        await socket.send_json_to({'command': 'find_match'})
+        room_id = self.room_id_from(await socket.receive_from(timeout=self.timeout))
+        await socket.disconnect()
+        return user, room_id
+
+    async def measure(self, phase, commands, coroutine):
+        queries_before = self.queries.count
+        started = time.perf_counter()
+        result = await coroutine
+        elapsed = time.perf_counter() - started
+        queries = self.queries.count - queries_before
+        return result, {
+            'phase': phase,
+            'commands': commands,
+            'seconds': elapsed,
+            'commandsPerSecond': commands / elapsed if elapsed else None,
+            'queriesPerCommand': queries / commands if commands else None
+        }
+
+    async def collect(self, socket, expected, latencies):
+        # latencies maps each message list key in a frame to its samples.
+        received = 0
+        while received < expected:
+            frame = json.loads(await socket.receive_from(timeout=self.timeout))
+            if frame.get('contentType') != 'new_message':
+                continue
+            arrived = time.perf_counter()
+            for key, samples in latencies.items():
+                for message in frame.get(key, []):
+                    samples.append(arrived - float(message['content']))
+                    received += 1
+
+    async def debate(self, room_id, participants, judges, latencies):
+        participant_sockets = [await self.open(user, f"ws/participant-chat/{room_id}/") for user in participants]
+        judge_sockets = [await self.open(user, f"ws/judge-chat/{room_id}/") for user in judges]
+        judge_expected = self.messages_per_room + self.judge_messages_per_room
+        collectors = [
+            asyncio.ensure_future(self.collect(socket, self.messages_per_room, latencies))
+            for socket in participant_sockets
+        ] + [
+            asyncio.ensure_future(self.collect(socket, judge_expected, latencies))
+            for socket in judge_sockets
+        ]
+        # Judge notes are spread evenly between the participants' messages.
+        sends = [(i / self.messages_per_room, participant_sockets[i % len(participant_sockets)])
+                 for i in range(self.messages_per_room)]
+        sends += [(i / self.judge_messages_per_room, judge_sockets[i % len(judge_sockets)])
+                  for i in range(self.judge_messages_per_room)]
+        interval = 1.0 / self.message_rate if self.message_rate else 0
+        for _, sender in sorted(sends, key=lambda send: send[0]):
+            await sender.send_json_to({'command': 'new_messages', 'room': room_id, 'messages': repr(time.perf_counter())})
+            await asyncio.sleep(interval)
+        await asyncio.gather(*collectors)
+        for socket in participant_sockets + judge_sockets:
+            await socket.disconnect()
+
+    async def run(self, participants, judges):
+        self.queries.install()
+        try:
+            pairs = [participants[i:i + 2] for i in range(0, len(participants), 2)]
+            seated, matching = await self.measure(
+                'participant_find_match', len(participants),
+                self.run_pairs(pairs)
+            )
+            rooms = {}
+            for pair in seated:
+                for user, room_id in pair:
+                    rooms.setdefault(room_id, {'participants': [], 'judges': []})['participants'].append(user)
+
+            assigned, judging = await self.measure(
+                'judge_find_match', len(judges),
+                asyncio.gather(*[self.judge(user) for user in judges])
+            )
+            for user, room_id in assigned:
+                rooms[room_id]['judges'].append(user)
+
+            latencies = {'participantMessages': [], 'judgeMessages': []}
+            _, chatting = await self.measure(
+                'new_messages', (self.messages_per_room + self.judge_messages_per_room) * len(rooms),
+                asyncio.gather(*[
+                    self.debate(room_id, members['participants'], members['judges'], latencies)
+                    for room_id, members in rooms.items()
+                ])
+            )
+        finally:
+            self.queries.uninstall()
+
+        return {
+            'config': {
+                'rooms': self.rooms,
+                'judgesPerRoom': self.judges_per_room,
+                'messagesPerRoom': self.messages_per_room,
+                'judgeMessagesPerRoom': self.judge_messages_per_room,
+                'messageRate': self.message_rate
+            },
+            'matchesPerSecond': len(rooms) / matching['seconds'] if matching['seconds'] else None,
+            'messagesPerSecond': chatting['commandsPerSecond'],
+            'fanOutLatency': {
+                'deliveries': len(latencies['participantMessages']),
+                'p50': percentile(latencies['participantMessages'], 50),
+                'p99': percentile(latencies['participantMessages'], 99)
+            },
+            'judgeFanOutLatency': {
+                'deliveries': len(latencies['judgeMessages']),
+                'p50': percentile(latencies['judgeMessages'], 50),
+                'p99': percentile(latencies['judgeMessages'], 99)
+            },
+            'phases': [matching, judging, chatting]
+        }
+
+
+class ForwardingConsumer(ParticipantChatConsumer):
+    # A chat consumer whose socket only counts what it would have written.
+
+    def __init__(self):
+        super().__init__({'type': 'websocket'})
+        self.frames = 0
+        self.bytes_sent = 0
+
+    async def send(self, text_data=None, bytes_data=None, close=False):
+        self.frames += 1
+        self.bytes_sent += len(text_data.encode('utf8')) if text_data is not None else len(bytes_data or b'')
+
+
+class FanOutEncodingBenchmark:
+    # Delivers chat_message events to a group of chat consumers, once with
+    # the frame every recipient has to encode and once with the frame encoded
+    # by the sender, and reports the handler cost per recipient.
+
+    def __init__(self, recipients=7, events=2000, messages_per_frame=1, body_length=280):
+        self.recipients = recipients
+        self.events = events
+        self.messages_per_frame = messages_per_frame
+        self.body_length = body_length
+
+    def frame(self):
+        messages = [
+            {
+                'id': i,
+                'username': f"debater{i % 2}",
+                'content': ("lorem ipsum " * self.body_length)[:self.body_length],
+                'timestamp': '2020-03-01 12:00:00.000000+00:00',
+                'userid': i % 2,
+                'sequence': i + 1
+            }
+            for i in range(self.messages_per_frame)
+        ]
+        return {'contentType': 'new_message', 'participantMessages': messages, 'participantSequence': len(messages)}
+
+    async def deliver(self, build_event):
+        consumers = [ForwardingConsumer() for _ in range(self.recipients)]
+        started = time.perf_counter()
+        for _ in range(self.events):
+            event = build_event()
+            for consumer in consumers:
+                await consumer.chat_message(event)
+        seconds = time.perf_counter() - started
+        deliveries = self.events * self.recipients
+        return {
+            'seconds': seconds,
+            'deliveries': deliveries,
+            'microsecondsPerRecipient': seconds / deliveries * 1e6,
+            'bytesPerFrame': consumers[0].bytes_sent // self.events
+        }
+
+    async def run(self):
+        frame = self.frame()
+        per_recipient = await self.deliver(lambda: {'type': 'chat_message', 'data': frame})
+        encoded_once = await self.deliver(lambda: group_event('chat_message', frame))
+        return {
+            'config': {
+                'recipients': self.recipients,
+                'events': self.events,
+                'messagesPerFrame': self.messages_per_frame,
+                'bodyLength': self.body_length
+            },
+            'encodedPerRecipient': per_recipient,
+            'encodedOnce': encoded_once,
+            'speedup': per_recipient['seconds'] / encoded_once['seconds'] if encoded_once['seconds'] else None
+        }
@@ -0,0 +1,391 @@
+import asyncio
+import bisect
+import hashlib
+import uuid
+from collections import deque
+from channels.exceptions import ChannelFull
+from channels.layers import BaseChannelLayer
+from django.utils.module_loading import import_string
+from . import metrics
+
+ORIGIN_KEY = '__hybrid_origin__'
+GROUP_KEY = '__hybrid_group__'
+RELAY_KEY = '__hybrid_relay__'
+JOIN = 'hybrid.join'
+PRESENT = 'hybrid.present'
+LEAVE = 'hybrid.leave'
+
+
+def make_layer(config):
+    if not isinstance(config, dict):
+        return config
+    return import_string(config['BACKEND'])(**config.get('CONFIG', {}))
+
+
+class LocalInbox:
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self.messages = deque()
+        self.ready = asyncio.Event()
+
+    def put(self, message):
+        # Full inboxes drop the message, as group_send does on a full channel.
+        if len(self.messages) >= self.capacity:
+            return False
+        self.messages.append(message)
+        self.ready.set()
+        return True
+
+    def pop(self):
+        message = self.messages.popleft()
+        if not self.messages:
+            self.ready.clear()
+        return message
+
+
+class HybridChannelLayer(BaseChannelLayer):
+    """
+    Delivers group events to members connected to this process directly and
+    publishes once to the remote layer for everyone else. Each process joins
+    a single relay channel to the remote group in place of its members and
+    fans relayed events out locally.
+
+    A process announces itself to a group when its first member joins, and
+    the processes already there answer, so each one learns which peers hold
+    members. Once that has had settle_delay seconds to arrive, events go
+    straight to the peers' relays, and not over the wire at all for a room
+    whose members are all local. Peers that vanish without leaving only cost
+    extra sends. Every process sharing the remote layer must use this layer.
+    """
+
+    extensions = ['groups', 'flush']
+
+    def __init__(self, remote, capacity=100, settle_delay=1.0, **kwargs):
+        super().__init__(capacity=capacity, **kwargs)
+        self.remote = make_layer(remote)
+        self.settle_delay = settle_delay
+        self.worker_id = uuid.uuid4().hex
+        self.inboxes = {}
+        self.local_groups = {}
+        self.peers = {}
+        self.settled_at = {}
+        self.remote_receives = {}
+        self.relay_channel = None
+        self.relay_task = None
+        self.deliveries = {'local': 0, 'remote': 0, 'relayed': 0}
+
+    def count(self, path, amount=1):
+        self.deliveries[path] += amount
+        metrics.channel_layer_deliveries.inc(amount, label_value=path)
+
+    async def new_channel(self, prefix='specific.'):
+        channel = await self.remote.new_channel(prefix)
+        self.inboxes[channel] = LocalInbox(self.get_capacity(channel))
+        return channel
+
+    async def send(self, channel, message):
+        inbox = self.inboxes.get(channel)
+        if inbox is not None:
+            inbox.put(message)
+            self.count('local')
+            return
+        await self.remote.send(channel, message)
+
+    async def receive(self, channel):
+        inbox = self.inboxes.get(channel)
+        if inbox is None:
+            return await self.remote.receive(channel)
+        # A remote receive that loses the race to a local message is kept for
+        # the next call rather than cancelled mid-flight.
+        while not inbox.messages:
+            remote = self.remote_receives.get(channel)
+            if remote is None:
+                remote = self.remote_receives[channel] = asyncio.ensure_future(self.remote.receive(channel))
+            local = asyncio.ensure_future(inbox.ready.wait())
+            try:
+                await asyncio.wait([remote, local], return_when=asyncio.FIRST_COMPLETED)
+            except asyncio.CancelledError:
+                local.cancel()
+                self.drop_channel(channel)
+                raise
+            local.cancel()
+            if remote.done():
+                del self.remote_receives[channel]
+                return remote.result()
+        return inbox.pop()
+
+    def drop_channel(self, channel):
+        self.inboxes.pop(channel, None)
+        remote = self.remote_receives.pop(channel, None)
+        if remote is not None:
+            remote.cancel()
+
+    async def ensure_relay(self):
+        if self.relay_channel is None:
+            self.relay_channel = await self.remote.new_channel('relay')
+        if self.relay_task is None or self.relay_task.done():
+            self.relay_task = asyncio.ensure_future(self.relay())
+
+    async def relay(self):
+        while True:
+            message = await self.remote.receive(self.relay_channel)
+            origin = message.pop(ORIGIN_KEY, None)
+            group = message.pop(GROUP_KEY, None)
+            if origin == self.worker_id:
+                continue
+            if message.get('type') in (JOIN, PRESENT, LEAVE):
+                await self.track_peer(group, origin, message)
+            else:
+                self.count('relayed', self.deliver_local(group, message))
+
+    async def track_peer(self, group, origin, message):
+        peers = self.peers.get(group)
+        if peers is None:
+            return
+        if message['type'] == LEAVE:
+            peers.pop(origin, None)
+            return
+        peers[origin] = message[RELAY_KEY]
+        if message['type'] == JOIN:
+            await self.send_remote(message[RELAY_KEY], self.control(PRESENT, group))
+
+    def control(self, kind, group):
+        return {'type': kind, ORIGIN_KEY: self.worker_id, GROUP_KEY: group, RELAY_KEY: self.relay_channel}
+
+    async def send_remote(self, channel, message):
+        try:
+            await self.remote.send(channel, message)
+        except ChannelFull:
+            pass
+
+    def deliver_local(self, group, message):
+        delivered = 0
+        for channel in self.local_groups.get(group, ()):
+            inbox = self.inboxes.get(channel)
+            if inbox is not None and inbox.put(dict(message)):
+                delivered += 1
+        return delivered
+
+    async def group_add(self, group, channel):
+        if channel not in self.inboxes:
+            await self.remote.group_add(group, channel)
+            return
+        members = self.local_groups.setdefault(group, set())
+        if not members:
+            await self.ensure_relay()
+            await self.remote.group_add(group, self.relay_channel)
+            self.peers[group] = {}
+            self.settled_at[group] = asyncio.get_event_loop().time() + self.settle_delay
+            await self.remote.group_send(group, self.control(JOIN, group))
+        members.add(channel)
+
+    async def group_discard(self, group, channel):
+        if channel not in self.inboxes:
+            await self.remote.group_discard(group, channel)
+            return
+        members = self.local_groups.get(group)
+        if members is None:
+            return
+        members.discard(channel)
+        if not members:
+            del self.local_groups[group]
+            del self.peers[group]
+            del self.settled_at[group]
+            await self.remote.group_discard(group, self.relay_channel)
+            await self.remote.group_send(group, self.control(LEAVE, group))
+
+    async def group_send(self, group, message):
+        self.count('local', self.deliver_local(group, message))
+        relayed = dict(message, **{ORIGIN_KEY: self.worker_id, GROUP_KEY: group})
+        peers = self.peers.get(group)
+        if peers is None or asyncio.get_event_loop().time() < self.settled_at[group]:
+            await self.remote.group_send(group, relayed)
+            self.count('remote')
+            return
+        for relay_channel in list(peers.values()):
+            await self.send_remote(relay_channel, relayed)
+            self.count('remote')
+
+    async def flush(self):
+        self.inboxes = {}
+        self.local_groups = {}
+        self.peers = {}
+        self.settled_at = {}
+        await self.remote.flush()
+
+    async def close(self):
+        if self.relay_task is not None:
+            self.relay_task.cancel()
+            self.relay_task = None
+        for channel in list(self.remote_receives):
+            self.drop_channel(channel)
+        await self.remote.close()
+
+
+class HashRing:
+    def __init__(self, replicas=64):
+        self.replicas = replicas
+        self.points = []
+        self.owners = {}
+
+    @staticmethod
+    def hash(key):
+        return int(hashlib.md5(key.encode('utf8')).hexdigest()[:16], 16)
+
+    def add(self, name):
+        for replica in range(self.replicas):
+            point = self.hash(f'{name}:{replica}')
+            self.owners[point] = name
+            bisect.insort(self.points, point)
+
+    def remove(self, name):
+        self.points = [point for point in self.points if self.owners[point] != name]
+        self.owners = {point: owner for point, owner in self.owners.items() if owner != name}
+
+    def get(self, key):
+        index = bisect.bisect(self.points, self.hash(key)) % len(self.points)
+        return self.owners[self.points[index]]
+
+
+class ShardedChannelLayer(BaseChannelLayer):
+    """
+    Spreads groups over several channel layers by consistent hashing on the
+    id at the end of the group name, so every group of a room, and each
+    matchmaking group, lands on one shard whichever process sends to it.
+    A channel lives on the shard it was created on and gets a sibling
+    channel on each other shard one of its groups hashes to; receive
+    listens on all of them.
+    """
+
+    extensions = ['groups', 'flush']
+    SHARD_MARKER = 'shard-'
+
+    def __init__(self, shards, replicas=64, **kwargs):
+        super().__init__(**kwargs)
+        self.shards = {}
+        self.ring = HashRing(replicas)
+        for name, config in shards.items():
+            self.shards[name] = make_layer(config)
+            self.ring.add(name)
+        self.siblings = {}
+        self.changed = {}
+        self.pending = {}
+        self.local_groups = {}
+        self.group_shards = {}
+
+    def shard_key(self, group):
+        return group.rsplit('_', 1)[-1]
+
+    def shard_for_group(self, group):
+        return self.ring.get(self.shard_key(group))
+
+    def home_shard(self, channel):
+        marker = channel.find(self.SHARD_MARKER)
+        if marker == -1:
+            return self.ring.get(channel)
+        return channel[marker + len(self.SHARD_MARKER):].split('.', 1)[0]
+
+    async def new_channel(self, prefix='specific.'):
+        home = self.ring.get(uuid.uuid4().hex)
+        channel = await self.shards[home].new_channel(f'{prefix}{self.SHARD_MARKER}{home}')
+        self.siblings[channel] = {home: channel}
+        self.changed[channel] = asyncio.Event()
+        return channel
+
+    async def channel_on(self, channel, shard):
+        siblings = self.siblings.get(channel)
+        if siblings is None:
+            return channel
+        if shard not in siblings:
+            siblings[shard] = await self.shards[shard].new_channel(f'sibling.{self.SHARD_MARKER}{shard}')
+            self.changed[channel].set()
+        return siblings[shard]
+
+    async def send(self, channel, message):
+        await self.shards[self.home_shard(channel)].send(channel, message)
+
+    async def receive(self, channel):
+        siblings = self.siblings.get(channel)
+        if siblings is None:
+            return await self.shards[self.home_shard(channel)].receive(channel)
+        changed = self.changed[channel]
+        pending = self.pending.setdefault(channel, {})
+        while True:
+            changed.clear()
+            for shard, sibling in siblings.items():
+                if shard not in pending:
+                    pending[shard] = asyncio.ensure_future(self.shards[shard].receive(sibling))
+            waiter = asyncio.ensure_future(changed.wait())
+            try:
+                await asyncio.wait(list(pending.values()) + [waiter], return_when=asyncio.FIRST_COMPLETED)
+            except asyncio.CancelledError:
+                waiter.cancel()
+                self.drop_channel(channel)
+                raise
+            waiter.cancel()
+            for shard, task in list(pending.items()):
+                if task.done():
+                    del pending[shard]
+                    return task.result()
+
+    def drop_channel(self, channel):
+        for task in self.pending.pop(channel, {}).values():
+            task.cancel()
+        self.siblings.pop(channel, None)
+        self.changed.pop(channel, None)
+
+    async def group_add(self, group, channel):
+        shard = self.shard_for_group(group)
+        await self.shards[shard].group_add(group, await self.channel_on(channel, shard))
+        if channel in self.siblings:
+            self.local_groups.setdefault(group, set()).add(channel)
+            self.group_shards[group] = shard
+
+    async def group_discard(self, group, channel):
+        shard = self.group_shards.get(group) or self.shard_for_group(group)
+        await self.shards[shard].group_discard(group, await self.channel_on(channel, shard))
+        members = self.local_groups.get(group)
+        if members is not None:
+            members.discard(channel)
+            if not members:
+                del self.local_groups[group]
+                del self.group_shards[group]
+
+    async def group_send(self, group, message):
+        await self.shards[self.shard_for_group(group)].group_send(group, message)
+
+    async def add_shard(self, name, config):
+        # Every process must add the shard; each one moves the memberships
+        # of its own channels for groups that now hash to the new shard.
+        self.shards[name] = make_layer(config)
+        self.ring.add(name)
+        return await self.rebalance()
+
+    async def remove_shard(self, name):
+        self.ring.remove(name)
+        return await self.rebalance()
+
+    async def rebalance(self):
+        moved = []
+        for group, members in list(self.local_groups.items()):
+            old, new = self.group_shards[group], self.shard_for_group(group)
+            if old == new:
+                continue
+            for channel in members:
+                await self.shards[old].group_discard(group, await self.channel_on(channel, old))
+                await self.shards[new].group_add(group, await self.channel_on(channel, new))
+            self.group_shards[group] = new
+            moved.append(group)
+        return moved
+
+    async def flush(self):
+        self.local_groups = {}
+        self.group_shards = {}
+        for shard in self.shards.values():
+            await shard.flush()
+
+    async def close(self):
+        for channel in list(self.pending):
+            self.drop_channel(channel)
+        for shard in self.shards.values():
+            await shard.close()
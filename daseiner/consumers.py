@@ -1,10 +1,20 @@
 from django.contrib.auth import get_user_model
 from django.contrib.auth.models import User
-from channels.db import database_sync_to_async
 from channels.generic.websocket import WebsocketConsumer, AsyncWebsocketConsumer
 from channels.layers import get_channel_layer
 from .models import ParticipantMessage, Room, ParticipantConnection, Question, JudgeConnection, WaitingJudge, JudgeMessage
-from django.db import models
+from . import transcripts
+from .matchmaking import matchmaker
+from .turns import get_turn_schedule
+from . import session_state
+from . import tickets
+from .frames import group_event, event_text, visible_to, room_group_name, PARTICIPANTS, JUDGES, ALL
+from .instrumentation import database_sync_to_async, unit_of_work, InstrumentedCommandMixin
+from .metrics import MetricsConsumerMixin
+from . import metrics
+from django.db import models, transaction
+from django.conf import settings
+import asyncio
 import celery
 import random
 import time
@@ -12,7 +22,19 @@ import datetime
 import threading
 import json
 
-class ParticipantChatConsumer(AsyncWebsocketConsumer):
+def room_id_message(event, user, with_ticket):
+    # Clients that ask for a ticket get it alongside the room id; older
+    # clients keep receiving the bare room id string.
+    if not with_ticket:
+        return event['room_id']
+    return {
+        'roomId': event['room_id'],
+        'ticket': tickets.make_ticket(event['room_id'], event['role'], user.id, event['activated_date'])
+    }
+
+class ParticipantChatConsumer(InstrumentedCommandMixin, MetricsConsumerMixin, AsyncWebsocketConsumer):
+    audience = PARTICIPANTS
+
     async def connect(self):
         current_user = await self.scope['user']
         self.current_user = current_user
@@ -21,10 +43,9 @@ class ParticipantChatConsumer(AsyncWebsocketConsumer):
         else:
             try:
                 self.room_name = self.scope['url_route']['kwargs']['room_name']
-                self.participant_room_group_name = 'participant_chat_%s' % self.room_name
-                self.judge_room_group_name = 'judge_chat_%s' % self.room_name
+                self.room_group_name = room_group_name(self.room_name)
                 await self.channel_layer.group_add(
-                    self.participant_room_group_name,
+                    self.room_group_name,
                     self.channel_name
                 )
 
@@ -34,7 +55,7 @@ class ParticipantChatConsumer(AsyncWebsocketConsumer):
 
     async def disconnect(self, close_code):
         await self.channel_layer.group_discard(
-            self.participant_room_group_name,
+            self.room_group_name,
             self.channel_name
         )
 
@@ -42,102 +63,120 @@ class ParticipantChatConsumer(AsyncWebsocketConsumer):
 
     async def receive(self, text_data):
         data = json.loads(text_data)
-        await self.commands[data['command']](self, data)
-
-    async def format_messages(self, messages):
-        jsonified_messages = await database_sync_to_async(self.populate_messages)(messages)
-        return jsonified_messages
+        await self.dispatch_command(data)
 
-    def populate_messages(self, messages):
-        result = []
-        if messages.count() == 0:
+    async def fetch_messages(self, data):
+        try:
+            formated_messages, has_more = await database_sync_to_async(self.get_message_page)(data)
+        except transcripts.InvalidCursor:
+            await self.send_fetched_message({'contentType': 'invalid_cursor'})
             return
-        elif messages.count() == 1:
-            result = [self.message_to_json(messages[0])]
-        else:
-            for message in messages.order_by('create_date'):
-                json_message = self.message_to_json(message)
-                result.append(json_message)
-        return result
-
-    def message_to_json(self, message):
-        return {
-            'username': message.participant_connection.user.username,
-            'content': message.body,
-            'timestamp': str(message.create_date),
-            'userid': message.participant_connection.user.id
+        content = {
+            'contentType': 'fetched_messages',
+            'participantMessages': formated_messages,
+            'participantHasMore': has_more
         }
+        await self.send_fetched_message(content)
 
-    async def fetch_messages(self, data):
-        messages = await database_sync_to_async(ParticipantMessage.objects.filter)(participant_connection__room=data['room'])
-        formated_messages = await self.format_messages(messages)
-        content = {'contentType': 'fetched_messages', 'participantMessages': formated_messages}
+    def get_message_page(self, data):
+        return transcripts.participant_transcript.load_page(
+            data['room'],
+            before=transcripts.parse_cursor(data.get('participantBefore')),
+            after=transcripts.parse_cursor(data.get('participantAfter')),
+            limit=transcripts.page_size(data)
+        )
+
+    async def fetch_missed_messages(self, data):
+        formated_messages = await database_sync_to_async(transcripts.participant_transcript.load_since)(
+            data['room'], data.get('participantSequence', 0))
+        content = {'contentType': 'missed_messages', 'participantMessages': formated_messages}
         await self.send_fetched_message(content)
 
     async def new_messages(self, data):
-        p_connection = await database_sync_to_async(ParticipantConnection.objects.get)(user=self.current_user, room=data['room'])
+        formated_messages, sequence = await self.store_message(data)
+        await self.send_chat_message(formated_messages, sequence)
+
+    @unit_of_work
+    def store_message(self, data):
+        p_connection = ParticipantConnection.objects.get(user=self.current_user, room=data['room'])
         message = ParticipantMessage(participant_connection=p_connection, body=data['messages'])
-        await database_sync_to_async(message.save)()
-        messages = await database_sync_to_async(ParticipantMessage.objects.filter)(participant_connection__room=data['room'])
-        formated_messages = await self.format_messages(messages)
-        await self.send_chat_message(formated_messages, self.participant_room_group_name)
-        await self.send_chat_message(formated_messages, self.judge_room_group_name)
+        formated_message = self.save_message(message)
+        if settings.CHAT_FULL_HISTORY_BROADCAST:
+            return transcripts.participant_transcript.load_all(data['room']), message.sequence
+        return [formated_message], message.sequence
+
+    def save_message(self, message):
+        return transcripts.participant_transcript.save(message, self.current_user)
 
     async def terminate_match(self, data):
-        room = await database_sync_to_async(Room.objects.get)(pk=data['room'])
-        await database_sync_to_async(room.close_room)()
-        await self.send_terminate_to_group(self.participant_room_group_name)
-        await self.send_terminate_to_group(self.judge_room_group_name)
-
-    async def send_chat_message(self, message, room_group_name):
-        await self.channel_layer.group_send(
-            room_group_name,
-            {
-                'type': 'chat_message',
-                'data': {
+        await self.close_room(data['room'])
+        await self.send_terminate_to_group()
+
+    @unit_of_work
+    def close_room(self, room_id):
+        Room.objects.get(pk=room_id).close_room()
+
+    async def send_chat_message(self, message, sequence):
+        await self.group_send(
+            self.room_group_name,
+            group_event(
+                'chat_message',
+                {
                     'contentType': 'new_message',
-                    'participantMessages': message
-                }
-            }
+                    'participantMessages': message,
+                    'participantSequence': sequence
+                },
+                ALL
+            )
         )
 
-    async def send_terminate_to_group(self, room_group_name):
-        await self.channel_layer.group_send(
-            room_group_name,
+    async def send_terminate_to_group(self):
+        event = group_event(
+            'terminate_notification',
             {
-                'type': 'terminate_notification',
-                'data': {
-                    'contentType': 'termination_notification',
-                    'participantMessages': [
-                        { 
-                            'username': self.current_user.username,
-                            'content': self.current_user.id,
-                            'timestamp': str(datetime.datetime.now(datetime.timezone.utc)),
-                            'userid': self.current_user.id
-                        }
-                    ] 
-                }
-            }
+                'contentType': 'termination_notification',
+                'participantMessages': [
+                    { 
+                        'username': self.current_user.username,
+                        'content': self.current_user.id,
+                        'timestamp': str(datetime.datetime.now(datetime.timezone.utc)),
+                        'userid': self.current_user.id
+                    }
+                ] 
+            },
+            ALL
         )
+        await self.group_send(self.room_group_name, event)
 
     async def send_fetched_message(self, message):
         await self.send(text_data=json.dumps(message))
 
     async def chat_message(self, event):
-        message = event['data']
-        await self.send(text_data=json.dumps(message))
+        if visible_to(event, self.audience):
+            await self.send(text_data=event_text(event))
 
     async def terminate_notification(self, event):
-        message = event['data']
-        await self.send(text_data=json.dumps(message))
+        if visible_to(event, self.audience):
+            await self.send(text_data=event_text(event))
+
+    async def turn_changed(self, event):
+        if visible_to(event, self.audience):
+            await self.send(text_data=event_text(event))
+
+    async def fetch_turn(self, data):
+        schedule = await database_sync_to_async(get_turn_schedule)(data['room'])
+        turn_state = schedule.to_json(self.current_user.id) if schedule else None
+        await self.send_fetched_message({'contentType': 'turn_state', 'turnState': turn_state})
 
     commands = {
         'fetch_messages': fetch_messages,
+        'fetch_missed_messages': fetch_missed_messages,
+        'fetch_turn': fetch_turn,
         'new_messages': new_messages,
         'terminate_match': terminate_match
     }
 
-class ParticipantMatchingConsumer(AsyncWebsocketConsumer):
+class ParticipantMatchingConsumer(InstrumentedCommandMixin, MetricsConsumerMixin, AsyncWebsocketConsumer):
     async def connect(self):
         current_user = await self.scope['user']
         self.current_user = current_user
@@ -148,25 +187,13 @@ class ParticipantMatchingConsumer(AsyncWebsocketConsumer):
             self.room_name = self.scope['url_route']['kwargs']['room_name']
             self.room_group_name = 'participant_searching_%s' % self.room_name
             self.match_found = False
+            self.with_ticket = False
             await self.channel_layer.group_add(self.room_group_name, self.channel_name)
             await self.accept()
 
     async def disconnect(self, close_code):
-        clean_up_room = False
         if not self.match_found:
-            initial_room_connection = await database_sync_to_async(Room.objects.filter)(initial_connection_id=self.room_name)
-            initial_connection_exists = await database_sync_to_async(initial_room_connection.exists)()
-            if initial_connection_exists:
-                room = await database_sync_to_async(initial_room_connection[:1].get)()
-                if not room.activated_date:
-                    clean_up_room = True
-                
-            if not initial_connection_exists:
-                clean_up_room = True
-
-            if clean_up_room:
-                disconnected_room = await database_sync_to_async(Room.objects.get)(initial_connection_id=self.room_name)
-                await database_sync_to_async(disconnected_room.remove_room)()
+            await database_sync_to_async(matchmaker.cancel)(self.room_name)
 
         await self.channel_layer.group_discard(
             self.room_group_name,
@@ -175,50 +202,29 @@ class ParticipantMatchingConsumer(AsyncWebsocketConsumer):
         await self.close()
 
     async def find_match(self, data):
-        room_queryset = await database_sync_to_async(Room.objects.filter)(is_open=True)
-        room_count = await database_sync_to_async(room_queryset.count)()
-        if room_count == 0:
-            first_user = self.current_user
-            randomized_questions = await database_sync_to_async(Question.objects.order_by)("?")
-            question = await database_sync_to_async(randomized_questions.first)()
-            new_room = Room(initial_connection_id=self.room_name,question=question)
-            await database_sync_to_async(new_room.save)()
-            first_user_connection = ParticipantConnection(user=first_user, room=new_room, is_current_speaker=True)
-            await database_sync_to_async(first_user_connection.save)()
-        else:
-            room = await database_sync_to_async(room_queryset.first)()
-            match_made = await self.make_match(data, room)
-            if match_made and room.is_open:
-                await database_sync_to_async(room.set_room_match)()
-                self.match_found = True
-                await database_sync_to_async(celery.current_app.send_task)('daseiner.tasks.change_turns', (room.id,))
-                await self.send_room_id(str(room.id), self.room_group_name)
-                await self.send_room_id(str(room.id), f"participant_searching_{room.initial_connection_id}")
-                await database_sync_to_async(self.add_judges_to_room)(room)
-                
-    def add_judges_to_room(self, room):
-        queued_judges = WaitingJudge.objects.all()
-        queued_judges_count = queued_judges.count()
-        if queued_judges_count > 0:
-            ordered_judges = queued_judges.order_by("create_date")
-            for queued_judge in ordered_judges:
-                new_connection = JudgeConnection(room=room, user=queued_judge.user).save()
-                if new_connection:
-                    queued_judge.send_room_id(str(room.id))
-                    queued_judge.delete()
-
-
-    async def make_match(self, data, open_room):
-        second_user = self.current_user
-        rooms_to_match = await database_sync_to_async(Room.objects.filter)(participantconnection__user=second_user, id=open_room.id)
-        room_count = await database_sync_to_async(rooms_to_match.count)()
-        if room_count != 0:
-            return None
-        else:
-            second_user_connection = ParticipantConnection(user=second_user, room=open_room)
-            await database_sync_to_async(second_user_connection.save)()
-            return second_user_connection
-            
+        self.with_ticket = data.get('withTicket', False)
+        match, judge_group_names = await self.pair()
+        if match.matched:
+            room = match.room
+            self.match_found = True
+            await self.send_room_id(room, self.room_group_name, tickets.PARTICIPANT)
+            await self.send_room_id(room, f"participant_searching_{room.initial_connection_id}", tickets.PARTICIPANT)
+            await self.add_judges_to_room(room, judge_group_names)
+
+    @unit_of_work
+    def pair(self):
+        match = matchmaker.find_match(self.current_user, self.room_name)
+        if not match.matched:
+            return match, []
+        room_id = match.room.id
+        transaction.on_commit(lambda: celery.current_app.send_task('daseiner.tasks.change_turns', (room_id,)))
+        return match, matchmaker.dispatch_waiting_judges(match.room)
+
+    async def add_judges_to_room(self, room, judge_group_names):
+        await asyncio.gather(
+            *[self.send_room_id(room, group_name, tickets.JUDGE) for group_name in judge_group_names]
+        )
+
     commands = {
         'find_match': find_match
     }
@@ -228,23 +234,27 @@ class ParticipantMatchingConsumer(AsyncWebsocketConsumer):
             'room_id':str(message)
         }
 
-    async def send_room_id(self, room_id, group_name):
-        await self.channel_layer.group_send(
+    async def send_room_id(self, room, group_name, role):
+        await self.group_send(
             group_name,
             {
                 'type': 'room_id',
-                'room_id': str(room_id)
+                'room_id': str(room.id),
+                'role': role,
+                'activated_date': room.activated_date.isoformat()
             }
         )
 
     async def room_id(self, event):
-        await self.send(text_data=json.dumps(event['room_id']))
+        await self.send(text_data=json.dumps(room_id_message(event, self.current_user, self.with_ticket)))
 
     async def receive(self, text_data):
         data = json.loads(text_data)
-        await self.commands[data['command']](self, data)
+        await self.dispatch_command(data)
+
+class JudgeChatConsumer(InstrumentedCommandMixin, MetricsConsumerMixin, AsyncWebsocketConsumer):
+    audience = JUDGES
 
-class JudgeChatConsumer(AsyncWebsocketConsumer):
     async def connect(self):
         try:
             current_user = await self.scope['user']
@@ -253,10 +263,10 @@ class JudgeChatConsumer(AsyncWebsocketConsumer):
                 return
             else:
                 self.room_name = self.scope['url_route']['kwargs']['room_name']
-                self.judge_room_group_name = 'judge_chat_%s' % self.room_name
+                self.room_group_name = room_group_name(self.room_name)
 
                 await self.channel_layer.group_add(
-                    self.judge_room_group_name,
+                    self.room_group_name,
                     self.channel_name
                 )
 
@@ -266,112 +276,130 @@ class JudgeChatConsumer(AsyncWebsocketConsumer):
 
     async def disconnect(self, close_code):
         await self.channel_layer.group_discard(
-            self.judge_room_group_name,
+            self.room_group_name,
             self.channel_name
         )
         await self.close()
 
     async def receive(self, text_data):
         data = json.loads(text_data)
-        await self.commands[data['command']](self, data)
-
-    def messages_to_json(self, messages, is_participant_message):
-        result = []
-        for message in messages:
-            result.append(self.message_to_json(message, is_participant_message))
-        return result
-
-    def message_to_json(self, message, is_participant_message):
-        username = ''
-        userid = None
-        if is_participant_message:
-            username = message.participant_connection.user.username
-            userid = message.participant_connection.user.id
-        else :
-            username = message.judge_connection.user.username
-            userid = message.judge_connection.user.id
-
-        return {
-            'username':username,
-            'content': message.body,
-            'timestamp': str(message.create_date),
-            'userid': userid
-        }
+        await self.dispatch_command(data)
 
     async def fetch_messages(self, data):
-        judge_messages = await database_sync_to_async(self.get_judge_messages)(data)
-        participant_messages = await database_sync_to_async(self.get_participant_messages)(data)
+        try:
+            (judge_messages, judge_has_more), (participant_messages, participant_has_more) = await self.get_message_pages(data)
+        except transcripts.InvalidCursor:
+            await self.send_fetched_message({'contentType': 'invalid_cursor'})
+            return
         await self.send_fetched_message(
             {
                 'contentType': 'fetched_messages', 
                 'judgeMessages': judge_messages,
-                'participantMessages': participant_messages
+                'judgeHasMore': judge_has_more,
+                'participantMessages': participant_messages,
+                'participantHasMore': participant_has_more
             }
         )
 
-    def get_participant_messages(self, data):
-        participant_messages = ParticipantMessage.objects.filter(
-            participant_connection__room=data['room']).order_by('create_date')
+    @unit_of_work
+    def get_message_pages(self, data):
+        return self.get_judge_messages(data), self.get_participant_messages(data)
 
-        if participant_messages.count() == 0:
-            participant_messages = []
-        elif participant_messages.count() == 1:
-            participant_messages = [self.message_to_json(participant_messages[:1].get(), True)]
-        else:
-            participant_messages = self.messages_to_json(participant_messages, True)
-        return participant_messages
+    def get_participant_messages(self, data):
+        return transcripts.participant_transcript.load_page(
+            data['room'],
+            before=transcripts.parse_cursor(data.get('participantBefore')),
+            after=transcripts.parse_cursor(data.get('participantAfter')),
+            limit=transcripts.page_size(data)
+        )
 
     def get_judge_messages(self, data):
-        judge_messages = JudgeMessage.objects.filter(
-            judge_connection__room=data['room']).order_by('create_date')
+        return transcripts.judge_transcript.load_page(
+            data['room'],
+            before=transcripts.parse_cursor(data.get('judgeBefore')),
+            after=transcripts.parse_cursor(data.get('judgeAfter')),
+            limit=transcripts.page_size(data)
+        )
 
-        if judge_messages.count() == 0:
-            judge_messages = []
-        elif judge_messages.count() == 1:
-            judge_messages = [self.message_to_json(judge_messages[:1].get(), False)]
-        else:
-            judge_messages = self.messages_to_json(judge_messages, False)
-        return judge_messages
 
+    async def fetch_missed_messages(self, data):
+        judge_messages, participant_messages = await self.get_missed_messages(data)
+        await self.send_fetched_message(
+            {
+                'contentType': 'missed_messages',
+                'judgeMessages': judge_messages,
+                'participantMessages': participant_messages
+            }
+        )
+
+    @unit_of_work
+    def get_missed_messages(self, data):
+        return self.get_missed_judge_messages(data), self.get_missed_participant_messages(data)
+
+    def get_missed_participant_messages(self, data):
+        return transcripts.participant_transcript.load_since(data['room'], data.get('participantSequence', 0))
+
+    def get_missed_judge_messages(self, data):
+        return transcripts.judge_transcript.load_since(data['room'], data.get('judgeSequence', 0))
 
     async def new_messages(self, data):
-        j_connection = await database_sync_to_async(JudgeConnection.objects.get)(user=self.current_user, room=data['room'])
+        jsonified_messages, sequence = await self.store_message(data)
+        await self.send_chat_message(jsonified_messages, sequence)
+
+    @unit_of_work
+    def store_message(self, data):
+        j_connection = JudgeConnection.objects.get(user=self.current_user, room=data['room'])
         message = JudgeMessage(judge_connection=j_connection, body=data['messages'])
-        await database_sync_to_async(message.save)()
-        judge_messages = await database_sync_to_async(JudgeMessage.objects.filter)(judge_connection__room=data['room'])
-        ordered_messages = await database_sync_to_async(judge_messages.order_by)('create_date')
-        jsonified_messages = await database_sync_to_async(self.messages_to_json)(ordered_messages, False)
-        await self.send_chat_message(jsonified_messages)
-
-    async def send_chat_message(self, message):
-        await self.channel_layer.group_send(
-            self.judge_room_group_name,
-            {
-                'type': 'chat_message',
-                'data': {
+        jsonified_message = self.save_message(message)
+        if settings.CHAT_FULL_HISTORY_BROADCAST:
+            return transcripts.judge_transcript.load_all(data['room']), message.sequence
+        return [jsonified_message], message.sequence
+
+    def save_message(self, message):
+        return transcripts.judge_transcript.save(message, self.current_user)
+
+    async def send_chat_message(self, message, sequence):
+        await self.group_send(
+            self.room_group_name,
+            group_event(
+                'chat_message',
+                {
                     'contentType': 'new_message',
-                    'judgeMessages': message
-                }
-            }
+                    'judgeMessages': message,
+                    'judgeSequence': sequence
+                },
+                JUDGES
+            )
         )
 
     async def send_fetched_message(self, message):
         await self.send(text_data=json.dumps(message))
 
     async def chat_message(self, event):
-        message = event['data']
-        await self.send(text_data=json.dumps(message))
+        if visible_to(event, self.audience):
+            await self.send(text_data=event_text(event))
 
     async def terminate_notification(self, event):
-        message = event['data']
-        await self.send(text_data=json.dumps(message))
+        if visible_to(event, self.audience):
+            await self.send(text_data=event_text(event))
+
+    async def turn_changed(self, event):
+        if visible_to(event, self.audience):
+            await self.send(text_data=event_text(event))
+
+    async def fetch_turn(self, data):
+        schedule = await database_sync_to_async(get_turn_schedule)(data['room'])
+        turn_state = schedule.to_json(self.current_user.id) if schedule else None
+        await self.send_fetched_message({'contentType': 'turn_state', 'turnState': turn_state})
 
     commands = {
         'fetch_messages': fetch_messages,
+        'fetch_missed_messages': fetch_missed_messages,
+        'fetch_turn': fetch_turn,
         'new_messages': new_messages,
     }
 
-class JudgeMatchingConsumer(AsyncWebsocketConsumer):
+class JudgeMatchingConsumer(InstrumentedCommandMixin, MetricsConsumerMixin, AsyncWebsocketConsumer):
     async def connect(self):
         self.match_found = False
         current_user = await self.scope['user']
@@ -382,15 +410,13 @@ class JudgeMatchingConsumer(AsyncWebsocketConsumer):
             self.room_name = self.scope['url_route']['kwargs']['room_name']
             self.room_group_name = 'judging_%s' % self.room_name
             self.waiting_judge_user = None
+            self.with_ticket = False
             await self.channel_layer.group_add(self.room_group_name, self.channel_name)
             await self.accept()
 
     async def disconnect(self, close_code):
         if self.waiting_judge_user and not self.match_found:
-            judge_waiting = await database_sync_to_async(WaitingJudge.objects.filter)(user=self.waiting_judge_user)
-            judge_waiting_count = await database_sync_to_async(judge_waiting.count)()
-            if judge_waiting_count != 0:
-                await database_sync_to_async(judge_waiting.delete)()
+            await database_sync_to_async(self.leave_queue)()
         await self.channel_layer.group_discard(
             self.room_group_name,
             self.channel_name
@@ -399,56 +425,54 @@ class JudgeMatchingConsumer(AsyncWebsocketConsumer):
         await self.close()
 
     async def find_match(self, data):
-        matchable_rooms = await database_sync_to_async(Room.objects.filter)(is_open=False, termination_date=None)
-        matchable_rooms_count = await database_sync_to_async(matchable_rooms.count)()
-        waiting_judge_queue = await database_sync_to_async(WaitingJudge.objects.filter)(user=self.current_user)
-        waiting_judge_queue_count = await database_sync_to_async(waiting_judge_queue.count)() 
-        not_queued = waiting_judge_queue_count == 0
-        if not_queued:
-            if matchable_rooms_count == 0:
-                await database_sync_to_async(self.que_judge)()
-            else:
-                room  = await database_sync_to_async(self.find_room_for_judge)(matchable_rooms)
-                if self.match_found:
-                    await database_sync_to_async(room.save)()
-                    await self.send_room_id(room.id, self.room_group_name)
-                else:
-                    await database_sync_to_async(self.que_judge)()
+        self.with_ticket = data.get('withTicket', False)
+        room = await self.find_room_for_judge()
+        if room:
+            self.match_found = True
+            await self.send_room_id(room, self.room_group_name, tickets.JUDGE)
 
     def que_judge(self):
         waiting_judge = WaitingJudge(user=self.current_user, group_name=self.room_group_name)
         self.waiting_judge_user = self.current_user
         waiting_judge.save()
+        user_id = self.current_user.id
+        transaction.on_commit(lambda: session_state.set_queued(user_id, session_state.JUDGE))
+        transaction.on_commit(metrics.judge_queued)
+
+    def leave_queue(self):
+        deleted, _ = WaitingJudge.objects.filter(user=self.waiting_judge_user).delete()
+        if deleted:
+            user_id = self.waiting_judge_user.id
+            transaction.on_commit(lambda: session_state.set_idle(user_id))
+            transaction.on_commit(lambda: metrics.judges_left_queue(deleted, 'left'))
     
-    def find_room_for_judge(self, matchable_rooms):
-        room = None
-        for room in matchable_rooms:
-            duplicate_connection = JudgeConnection.objects.filter(room=room,user=self.current_user).count() != 0
-            connected_as_participant = ParticipantConnection.objects.filter(room=room,user=self.current_user).count() != 0
-            if not duplicate_connection and not connected_as_participant:
-                new_judge_connection = JudgeConnection(room=room,user=self.current_user).save()
-                if new_judge_connection:
-                    self.match_found = True
-                    room = Room.objects.get(pk=str(room.id))
-                    break
+    @unit_of_work
+    def find_room_for_judge(self):
+        if WaitingJudge.objects.filter(user=self.current_user).exists():
+            return None
+        room = matchmaker.assign_judge(self.current_user)
+        if room is None:
+            self.que_judge()
         return room
 
-    async def send_room_id(self, room_id, group_name):
-        await self.channel_layer.group_send(
+    async def send_room_id(self, room, group_name, role):
+        await self.group_send(
             group_name,
             {
                 'type': 'room_id',
-                'room_id': str(room_id)
+                'room_id': str(room.id),
+                'role': role,
+                'activated_date': room.activated_date.isoformat()
             }
         )
     
     async def room_id(self, event):
-        await self.send(text_data=json.dumps(event['room_id']))
+        await self.send(text_data=json.dumps(room_id_message(event, self.current_user, self.with_ticket)))
     
 
     async def receive(self, text_data):
         data = json.loads(text_data)
-        await self.commands[data['command']](self, data)
+        await self.dispatch_command(data)
 
     commands = {
         'find_match': find_match
@@ -0,0 +1,25 @@
+import json
+
+# Participants and judges of a room share one group; each event says who may
+# see it and every consumer drops what is not meant for it.
+PARTICIPANTS = 'participants'
+JUDGES = 'judges'
+ALL = 'all'
+
+
+def room_group_name(room_id):
+    return f'room_chat_{room_id}'
+
+def group_event(event_type, data, audience=ALL):
+    # Group events carry the frame already encoded, so each member of the
+    # group forwards the same text instead of serializing it again.
+    return {'type': event_type, 'text': json.dumps(data), 'audience': audience}
+
+def visible_to(event, audience):
+    return event.get('audience', ALL) in (ALL, audience)
+
+def event_text(event):
+    # Events queued by workers that predate encoded frames still carry 'data'.
+    if 'text' in event:
+        return event['text']
+    return json.dumps(event['data'])
@@ -0,0 +1,302 @@
+import asyncio
+import contextvars
+import functools
+import os
+import socket
+import threading
+import time
+from bisect import bisect_left
+from concurrent.futures import ThreadPoolExecutor
+from django.conf import settings
+from django.core.cache import cache
+from django.db import close_old_connections, connections, transaction
+from django.db.backends.signals import connection_created
+
+# Upper bounds for the histogram buckets, roughly doubling from 0.1ms so the
+# same layout covers seconds, query counts and payload sizes.
+BUCKET_BOUNDS = [0.0001 * 2 ** i for i in range(32)]
+
+PUBLISH_INTERVAL_SECONDS = 10
+PUBLISH_TIMEOUT_SECONDS = 5 * 60
+WORKERS_KEY = 'command_stats:workers'
+UNKNOWN_COMMAND = 'unknown'
+
+current_recorder = contextvars.ContextVar('current_recorder', default=None)
+thread_recorder = threading.local()
+connection_checks = threading.local()
+
+
+class Histogram:
+    def __init__(self):
+        self.buckets = [0] * (len(BUCKET_BOUNDS) + 1)
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def record(self, value):
+        self.buckets[bisect_left(BUCKET_BOUNDS, value)] += 1
+        self.count += 1
+        self.total += value
+        self.max = max(self.max, value)
+
+    def percentile(self, pct):
+        if not self.count:
+            return None
+        rank = pct / 100.0 * self.count
+        seen = 0
+        for index, bucket in enumerate(self.buckets):
+            seen += bucket
+            if seen >= rank:
+                return BUCKET_BOUNDS[index] if index < len(BUCKET_BOUNDS) else self.max
+        return self.max
+
+    def snapshot(self):
+        return {
+            'count': self.count,
+            'mean': self.total / self.count if self.count else None,
+            'p50': self.percentile(50),
+            'p99': self.percentile(99),
+            'max': self.max
+        }
+
+
+class CommandRecorder:
+    def __init__(self):
+        self.db_wait = 0.0
+        self.hops = 0
+        self.queries = 0
+        self.bytes_sent = 0
+
+
+class CommandStats:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.commands = {}
+        self.worker_id = f'{socket.gethostname()}:{os.getpid()}'
+        self.last_published = 0.0
+
+    def record(self, consumer, command, wall_time, recorder):
+        with self.lock:
+            histograms = self.commands.get((consumer, command))
+            if histograms is None:
+                histograms = self.commands[(consumer, command)] = {
+                    'wallTime': Histogram(),
+                    'dbWait': Histogram(),
+                    'hops': Histogram(),
+                    'queries': Histogram(),
+                    'bytesSent': Histogram()
+                }
+            histograms['wallTime'].record(wall_time)
+            histograms['dbWait'].record(recorder.db_wait)
+            histograms['hops'].record(recorder.hops)
+            histograms['queries'].record(recorder.queries)
+            histograms['bytesSent'].record(recorder.bytes_sent)
+
+    def snapshot(self):
+        with self.lock:
+            return {
+                f'{consumer}.{command}': {name: histogram.snapshot() for name, histogram in histograms.items()}
+                for (consumer, command), histograms in self.commands.items()
+            }
+
+    def publish(self):
+        # Each worker leaves its latest snapshot in the shared cache so the
+        # command_stats management command can read every process.
+        cache.set(f'command_stats:{self.worker_id}', self.snapshot(), PUBLISH_TIMEOUT_SECONDS)
+        workers = cache.get(WORKERS_KEY) or []
+        if self.worker_id not in workers:
+            cache.set(WORKERS_KEY, workers + [self.worker_id], None)
+        self.last_published = time.monotonic()
+
+    def publish_due(self):
+        return time.monotonic() - self.last_published > PUBLISH_INTERVAL_SECONDS
+
+
+command_stats = CommandStats()
+
+
+class ExecutorHop:
+    QUEUED = 'queued'
+    RUNNING = 'running'
+    ABANDONED = 'abandoned'
+
+    def __init__(self):
+        self.state = self.QUEUED
+        self.submitted = time.perf_counter()
+
+
+class ExecutorStats:
+    # Tracks sync hops waiting for and running on the executor. A hop
+    # submitted while every thread is taken counts as saturated.
+
+    def __init__(self, threads):
+        self.threads = threads
+        self.lock = threading.Lock()
+        self.waiting = 0
+        self.running = 0
+        self.submitted = 0
+        self.saturated = 0
+        self.queue_wait = Histogram()
+
+    def submit(self):
+        hop = ExecutorHop()
+        with self.lock:
+            if self.waiting + self.running >= self.threads:
+                self.saturated += 1
+            self.submitted += 1
+            self.waiting += 1
+        return hop
+
+    def start(self, hop):
+        with self.lock:
+            if hop.state == ExecutorHop.QUEUED:
+                self.waiting -= 1
+            hop.state = ExecutorHop.RUNNING
+            self.running += 1
+            self.queue_wait.record(time.perf_counter() - hop.submitted)
+
+    def finish(self, hop):
+        with self.lock:
+            self.running -= 1
+
+    def abandon(self, hop):
+        # The awaiting task was cancelled before a thread picked the hop up.
+        with self.lock:
+            if hop.state == ExecutorHop.QUEUED:
+                self.waiting -= 1
+                hop.state = ExecutorHop.ABANDONED
+
+    def snapshot(self):
+        with self.lock:
+            return {
+                'threads': self.threads,
+                'running': self.running,
+                'waiting': self.waiting,
+                'submitted': self.submitted,
+                'saturated': self.saturated,
+                'queueWait': self.queue_wait.snapshot()
+            }
+
+
+def check_connections():
+    # Connections outlive a hop under CONN_MAX_AGE. One this thread has left
+    # idle past DB_HEALTH_CHECK_INTERVAL is pinged before it is reused.
+    close_old_connections()
+    last_used = getattr(connection_checks, 'last_used', None)
+    if last_used is None:
+        last_used = connection_checks.last_used = {}
+    now = time.monotonic()
+    for connection in connections.all():
+        if connection.connection is None:
+            continue
+        idle = now - last_used.get(connection.alias, now)
+        if idle > settings.DB_HEALTH_CHECK_INTERVAL and not connection.is_usable():
+            connection.close()
+        last_used[connection.alias] = now
+
+
+class DatabaseExecutor:
+    # A thread pool reserved for sync database work. Each lane has its own
+    # pool, so websocket auth lookups never queue behind transcript reads.
+
+    def __init__(self, lane, threads):
+        self.lane = lane
+        self.threads = threads
+        self.stats = ExecutorStats(threads)
+        self.pool = ThreadPoolExecutor(max_workers=threads, thread_name_prefix=f'db-{lane}')
+
+    def call(self, recorder, hop, func, *args, **kwargs):
+        self.stats.start(hop)
+        thread_recorder.recorder = recorder
+        try:
+            check_connections()
+            return func(*args, **kwargs)
+        finally:
+            close_old_connections()
+            thread_recorder.recorder = None
+            self.stats.finish(hop)
+
+    async def run(self, recorder, func, *args, **kwargs):
+        hop = self.stats.submit()
+        loop = asyncio.get_event_loop()
+        try:
+            return await loop.run_in_executor(
+                self.pool, functools.partial(self.call, recorder, hop, func, *args, **kwargs))
+        finally:
+            self.stats.abandon(hop)
+
+
+executors = {
+    'default': DatabaseExecutor('default', settings.DB_EXECUTOR_THREADS),
+    'auth': DatabaseExecutor('auth', settings.DB_AUTH_EXECUTOR_THREADS),
+}
+
+
+def published_snapshots():
+    workers = cache.get(WORKERS_KEY) or []
+    snapshots = cache.get_many([f'command_stats:{worker}' for worker in workers])
+    return {key.split(':', 1)[1]: snapshot for key, snapshot in snapshots.items()}
+
+def count_query(execute, sql, params, many, context):
+    recorder = getattr(thread_recorder, 'recorder', None)
+    if recorder is not None:
+        recorder.queries += 1
+    return execute(sql, params, many, context)
+
+def attach_query_counter(sender, connection, **kwargs):
+    if count_query not in connection.execute_wrappers:
+        connection.execute_wrappers.append(count_query)
+
+connection_created.connect(attach_query_counter)
+
+def database_sync_to_async(func, lane='default'):
+    # Stands in for channels' database_sync_to_async: runs func on the lane's
+    # database executor and charges the time spent waiting on it, and the
+    # queries run there, to the command currently being dispatched.
+    executor = executors[lane]
+
+    @functools.wraps(func)
+    async def wrapper(*args, **kwargs):
+        recorder = current_recorder.get()
+        started = time.perf_counter()
+        try:
+            return await executor.run(recorder, func, *args, **kwargs)
+        finally:
+            if recorder is not None:
+                recorder.hops += 1
+                recorder.db_wait += time.perf_counter() - started
+    return wrapper
+
+def unit_of_work(func):
+    # Runs a command's whole database step in one executor hop and one
+    # transaction. The step should hand back plain data, not querysets or
+    # lazy relations that would need another hop to resolve.
+    @functools.wraps(func)
+    def atomic_call(*args, **kwargs):
+        with transaction.atomic():
+            return func(*args, **kwargs)
+    return database_sync_to_async(atomic_call)
+
+
+class InstrumentedCommandMixin:
+    async def dispatch_command(self, data):
+        # Commands the consumer does not handle share one bucket, so clients
+        # cannot grow the stats with made up names; they still fail as before.
+        command = data['command']
+        name = command if command in self.commands else UNKNOWN_COMMAND
+        recorder = CommandRecorder()
+        token = current_recorder.set(recorder)
+        started = time.perf_counter()
+        try:
+            await self.commands[command](self, data)
+        finally:
+            current_recorder.reset(token)
+            command_stats.record(type(self).__name__, name, time.perf_counter() - started, recorder)
+            if command_stats.publish_due():
+                await database_sync_to_async(command_stats.publish)()
+
+    async def send(self, text_data=None, bytes_data=None, close=False):
+        recorder = current_recorder.get()
+        if recorder is not None:
+            recorder.bytes_sent += len(text_data.encode('utf8')) if text_data is not None else len(bytes_data or b'')
+        await super().send(text_data=text_data, bytes_data=bytes_data, close=close)
@@ -0,0 +1,49 @@
+import datetime
+import json
+from asgiref.sync import async_to_sync
+from celery import current_app
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from django.test.utils import override_settings, setup_test_environment, teardown_test_environment
+from daseiner.benchmarks import ConsumerBenchmark, IN_MEMORY_CHANNEL_LAYERS
+
+
+class Command(BaseCommand):
+    help = "Drives the matching and chat consumers over the in-memory channel layer and a throwaway database"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--rooms', type=int, default=10)
+        parser.add_argument('--judges-per-room', type=int, default=2, help="At most the room's judge limit of 5")
+        parser.add_argument('--messages-per-room', type=int, default=20)
+        parser.add_argument('--judge-messages-per-room', type=int, default=5)
+        parser.add_argument('--message-rate', type=float, default=10.0, help="Messages per second per room")
+        parser.add_argument('--output', default='consumer_benchmark.json')
+
+    def handle(self, *args, **options):
+        try:
+            benchmark = ConsumerBenchmark(
+                rooms=options['rooms'],
+                judges_per_room=options['judges_per_room'],
+                messages_per_room=options['messages_per_room'],
+                judge_messages_per_room=options['judge_messages_per_room'],
+                message_rate=options['message_rate']
+            )
+        except ValueError as error:
+            raise CommandError(error)
+        # Turn scheduling still publishes a Celery task; keep it in memory.
+        current_app.conf.broker_url = 'memory://'
+        setup_test_environment()
+        database_name = connection.settings_dict['NAME']
+        connection.creation.create_test_db(verbosity=0, autoclobber=True)
+        try:
+            with override_settings(CHANNEL_LAYERS=IN_MEMORY_CHANNEL_LAYERS):
+                participants, judges = benchmark.create_users()
+                results = async_to_sync(benchmark.run)(participants, judges)
+        finally:
+            connection.creation.destroy_test_db(database_name, verbosity=0)
+            teardown_test_environment()
+
+        results['runAt'] = datetime.datetime.now(datetime.timezone.utc).isoformat()
+        with open(options['output'], 'w') as output:
+            json.dump(results, output, indent=2)
+        self.stdout.write(json.dumps(results, indent=2))
@@ -0,0 +1,30 @@
+import datetime
+import json
+from asgiref.sync import async_to_sync
+from django.core.management.base import BaseCommand
+from daseiner.benchmarks import FanOutEncodingBenchmark
+
+
+class Command(BaseCommand):
+    help = "Measures the per-recipient cost of delivering a chat frame to a room group"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--recipients', type=int, default=7, help="Both participants plus five judges by default")
+        parser.add_argument('--events', type=int, default=2000)
+        parser.add_argument('--messages-per-frame', type=int, default=1,
+                            help="Raise to mimic CHAT_FULL_HISTORY_BROADCAST frames")
+        parser.add_argument('--body-length', type=int, default=280)
+        parser.add_argument('--output', default='fanout_benchmark.json')
+
+    def handle(self, *args, **options):
+        benchmark = FanOutEncodingBenchmark(
+            recipients=options['recipients'],
+            events=options['events'],
+            messages_per_frame=options['messages_per_frame'],
+            body_length=options['body_length']
+        )
+        results = async_to_sync(benchmark.run)()
+        results['runAt'] = datetime.datetime.now(datetime.timezone.utc).isoformat()
+        with open(options['output'], 'w') as output:
+            json.dump(results, output, indent=2)
+        self.stdout.write(json.dumps(results, indent=2))
@@ -0,0 +1,10 @@
+import json
+from django.core.management.base import BaseCommand
+from daseiner.instrumentation import published_snapshots
+
+
+class Command(BaseCommand):
+    help = "Prints the per-command timing and query histograms published by each consumer worker"
+
+    def handle(self, *args, **options):
+        self.stdout.write(json.dumps(published_snapshots(), indent=2))
@@ -0,0 +1,337 @@
+import json
+import logging
+import threading
+import time
+import uuid
+from collections import deque
+from django.conf import settings
+from django.core.cache import cache
+from django.db import connection, transaction
+from django.db.models import Count, IntegerField, OuterRef, Subquery, Value
+from django.db.models.functions import Coalesce
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
+from django.utils.module_loading import import_string
+from .models import Room, ParticipantConnection, JudgeConnection, WaitingJudge, JUDGE_CONNECTION_LIMIT, CONNECTED, ROOM_FULL
+from .questions import question_deck, room_question_key, ROOM_QUESTION_TIMEOUT
+from . import session_state
+from . import metrics
+
+logger = logging.getLogger(__name__)
+
+JUDGE_ASSIGNMENT_ATTEMPTS = 3
+
+# Key of the Postgres advisory lock a searcher holds while opening a room.
+OPEN_ROOM_LOCK_ID = 0x6d61746368
+
+# How long a claimed Redis seat, or the right to open a room, is held for a
+# transaction that has not committed yet before it is given back.
+SEAT_LEASE_SECONDS = 10
+OPEN_ROOM_POLL_SECONDS = 0.01
+
+
+class Seat:
+    def __init__(self, room_id, user_id, enqueued_at, raw=None):
+        self.room_id = room_id
+        self.user_id = user_id
+        self.enqueued_at = enqueued_at
+        self.raw = raw
+
+
+class MatchResult:
+    def __init__(self, room, matched, latency=None):
+        self.room = room
+        self.matched = matched
+        self.latency = latency
+
+
+class DatabaseSeatQueue:
+    # Open rooms are the queue. Claiming a seat row-locks the oldest open
+    # room and skips rooms another worker is already pairing into. A searcher
+    # that finds none takes the open-room lock until its transaction ends and
+    # looks again, so of two searchers meeting an empty queue the second one
+    # joins the room the first opened. Other backends used here (SQLite) allow
+    # a single writer and need no lock.
+    #
+    # claim_seat returning None hands the caller the right to open a room;
+    # add_seat, seat_taken and release_seat are called on commit, after a
+    # pairing and on failure respectively.
+
+    def claim_seat(self, user):
+        seat = self.first_open_seat(user)
+        if seat is None and connection.vendor == 'postgresql':
+            with connection.cursor() as cursor:
+                cursor.execute('SELECT pg_advisory_xact_lock(%s)', [OPEN_ROOM_LOCK_ID])
+            seat = self.first_open_seat(user)
+        return seat
+
+    def first_open_seat(self, user):
+        room = Room.objects.select_for_update(skip_locked=True).filter(
+            is_open=True
+        ).exclude(participantconnection__user=user).order_by('create_date').first()
+        if room is None:
+            return None
+        return Seat(room.id, None, room.create_date)
+
+    def add_seat(self, seat):
+        pass
+
+    def seat_taken(self, seat):
+        pass
+
+    def release_seat(self, seat):
+        pass
+
+    def remove_seat(self, room_id):
+        pass
+
+
+class InMemorySeatQueue:
+    def __init__(self):
+        self.seats = deque()
+        self.lock = threading.Lock()
+
+    def claim_seat(self, user):
+        with self.lock:
+            for seat in self.seats:
+                if seat.user_id != user.id:
+                    self.seats.remove(seat)
+                    return seat
+        return None
+
+    def add_seat(self, seat):
+        with self.lock:
+            self.seats.append(seat)
+
+    def seat_taken(self, seat):
+        pass
+
+    def release_seat(self, seat):
+        with self.lock:
+            self.seats.appendleft(seat)
+
+    def remove_seat(self, room_id):
+        with self.lock:
+            self.seats = deque(seat for seat in self.seats if seat.room_id != room_id)
+
+
+class RedisSeatQueue:
+    # A claimed seat moves to a processing hash stamped with the claim time
+    # and is dropped from it once the pairing commits. If that never happens
+    # the next claim after SEAT_LEASE_SECONDS puts it back at the head of the
+    # queue. Finding no seat and taking the open-room lease is one script, so
+    # a second searcher waits for the first one's seat instead of opening a
+    # room of its own; the seat is pushed and the lease released together.
+
+    key = 'matchmaking:seats'
+    processing_key = 'matchmaking:seats:processing'
+    open_room_key = 'matchmaking:open_room'
+
+    claim_script = '''
+        local now, lease = tonumber(ARGV[2]), tonumber(ARGV[3])
+        local processing = redis.call('HGETALL', KEYS[2])
+        for i = 1, #processing, 2 do
+            if now - tonumber(processing[i + 1]) > lease then
+                redis.call('HDEL', KEYS[2], processing[i])
+                redis.call('LPUSH', KEYS[1], processing[i])
+            end
+        end
+        for _, raw in ipairs(redis.call('LRANGE', KEYS[1], 0, -1)) do
+            if tostring(cjson.decode(raw)['user_id']) ~= ARGV[1] then
+                redis.call('LREM', KEYS[1], 1, raw)
+                redis.call('HSET', KEYS[2], raw, now)
+                return raw
+            end
+        end
+        if redis.call('SET', KEYS[3], ARGV[4], 'NX', 'PX', lease) then
+            return 1
+        end
+        return 0
+    '''
+
+    add_script = '''
+        redis.call('RPUSH', KEYS[1], ARGV[1])
+        if redis.call('GET', KEYS[2]) == ARGV[2] then
+            redis.call('DEL', KEYS[2])
+        end
+    '''
+
+    release_script = '''
+        if redis.call('HDEL', KEYS[2], ARGV[1]) == 1 then
+            redis.call('LPUSH', KEYS[1], ARGV[1])
+        end
+    '''
+
+    def __init__(self, url=None):
+        import redis
+        self.redis = redis.Redis.from_url(url or settings.MATCHMAKING_REDIS_URL)
+        self.claim = self.redis.register_script(self.claim_script)
+        self.push = self.redis.register_script(self.add_script)
+        self.release = self.redis.register_script(self.release_script)
+        self.local = threading.local()
+
+    def encode(self, seat):
+        return json.dumps({
+            'room_id': str(seat.room_id),
+            'user_id': seat.user_id,
+            'enqueued_at': seat.enqueued_at.isoformat()
+        })
+
+    def decode(self, raw):
+        seat = json.loads(raw)
+        return Seat(seat['room_id'], seat['user_id'], parse_datetime(seat['enqueued_at']), raw)
+
+    def claim_seat(self, user):
+        token = uuid.uuid4().hex
+        lease = SEAT_LEASE_SECONDS * 1000
+        while True:
+            claimed = self.claim(
+                keys=[self.key, self.processing_key, self.open_room_key],
+                args=[str(user.id), int(time.time() * 1000), lease, token]
+            )
+            if claimed == 1:
+                self.local.open_room_token = token
+                return None
+            if claimed != 0:
+                return self.decode(claimed)
+            time.sleep(OPEN_ROOM_POLL_SECONDS)
+
+    def add_seat(self, seat):
+        token = getattr(self.local, 'open_room_token', None)
+        self.local.open_room_token = None
+        self.push(keys=[self.key, self.open_room_key], args=[self.encode(seat), token or ''])
+
+    def seat_taken(self, seat):
+        self.redis.hdel(self.processing_key, seat.raw)
+
+    def release_seat(self, seat):
+        self.release(keys=[self.key, self.processing_key], args=[seat.raw])
+
+    def remove_seat(self, room_id):
+        for raw in self.redis.lrange(self.key, 0, -1):
+            if self.decode(raw).room_id == str(room_id):
+                self.redis.lrem(self.key, 1, raw)
+
+
+class Matchmaker:
+    def __init__(self, queue=None):
+        self.queue = queue
+
+    def get_queue(self):
+        if self.queue is None:
+            self.queue = import_string(settings.MATCHMAKING_QUEUE)()
+        return self.queue
+
+    def find_match(self, user, connection_id):
+        queue = self.get_queue()
+        with transaction.atomic():
+            waiting_room = Room.objects.filter(is_open=True, participantconnection__user=user).first()
+            if waiting_room is not None:
+                return MatchResult(waiting_room, matched=False)
+
+            seat = queue.claim_seat(user)
+            while seat is not None:
+                try:
+                    room = Room.objects.select_for_update().filter(pk=seat.room_id, is_open=True).first()
+                    if room is not None and ParticipantConnection(user=user, room=room).take_seat() == CONNECTED:
+                        room.set_room_match()
+                    else:
+                        room = None
+                except Exception:
+                    queue.release_seat(seat)
+                    raise
+                transaction.on_commit(lambda seat=seat: queue.seat_taken(seat))
+                if room is not None:
+                    participant_ids = list(ParticipantConnection.objects.filter(room=room).values_list('user_id', flat=True))
+                    transaction.on_commit(lambda: session_state.set_in_room(
+                        participant_ids, session_state.PARTICIPANT, room.id, room.activated_date))
+                    latency = (timezone.now() - seat.enqueued_at).total_seconds()
+                    transaction.on_commit(lambda: metrics.pairing_latency_seconds.observe(latency))
+                    logger.info("Paired room %s after %.3fs", room.id, latency)
+                    return MatchResult(room, matched=True, latency=latency)
+                seat = queue.claim_seat(user)
+
+            room = Room(initial_connection_id=connection_id, question_id=question_deck.draw())
+            room.save()
+            cache.set(room_question_key(room.id), room.question_id, ROOM_QUESTION_TIMEOUT)
+            ParticipantConnection(user=user, room=room, is_current_speaker=True).take_seat()
+            seat = Seat(room.id, user.id, room.create_date)
+            transaction.on_commit(lambda: queue.add_seat(seat))
+            transaction.on_commit(lambda: session_state.set_queued(user.id, session_state.PARTICIPANT))
+            transaction.on_commit(metrics.room_opened)
+            return MatchResult(room, matched=False)
+
+    def judgeable_rooms(self, user):
+        judge_count = JudgeConnection.objects.filter(room=OuterRef('pk')).order_by().values('room').annotate(
+            total=Count('id')).values('total')
+        return Room.objects.filter(
+            is_open=False, termination_date=None
+        ).exclude(
+            judgeconnection__user=user
+        ).exclude(
+            participantconnection__user=user
+        ).annotate(
+            judge_count=Coalesce(Subquery(judge_count, output_field=IntegerField()), Value(0))
+        ).filter(
+            judge_count__lt=JUDGE_CONNECTION_LIMIT
+        ).order_by('judge_count', 'activated_date')
+
+    def assign_judge(self, user):
+        # One query picks and locks the active room with the fewest judges.
+        # Its judge count may predate the lock, so the seat constraints have
+        # the final say; if the room filled up the next candidate is tried.
+        with transaction.atomic():
+            for attempt in range(JUDGE_ASSIGNMENT_ATTEMPTS):
+                room = self.judgeable_rooms(user).select_for_update().first()
+                if room is None:
+                    return None
+                outcome = JudgeConnection(room=room, user=user).take_seat()
+                if outcome == CONNECTED:
+                    transaction.on_commit(lambda: session_state.set_in_room(
+                        [user.id], session_state.JUDGE, room.id, room.activated_date))
+                    return room
+                if outcome != ROOM_FULL:
+                    return None
+        return None
+
+    def dispatch_waiting_judges(self, room):
+        # Seats the oldest queued judges up to the room's free capacity and
+        # returns their group names; notifying them is left to the caller so
+        # no channel layer I/O happens while the room is locked.
+        with transaction.atomic():
+            room = Room.objects.select_for_update().get(pk=room.pk)
+            taken_seats = set(JudgeConnection.objects.filter(room=room).values_list('seat', flat=True))
+            free_seats = [seat for seat in range(1, JUDGE_CONNECTION_LIMIT + 1) if seat not in taken_seats]
+            if not free_seats:
+                return []
+            queued_judges = list(
+                WaitingJudge.objects.select_for_update(skip_locked=True).exclude(
+                    user__participantconnection__room=room
+                ).order_by('create_date')[:len(free_seats)]
+            )
+            if not queued_judges:
+                return []
+            JudgeConnection.objects.bulk_create(
+                [JudgeConnection(room=room, user_id=queued_judge.user_id, seat=seat)
+                 for queued_judge, seat in zip(queued_judges, free_seats)]
+            )
+            WaitingJudge.objects.filter(pk__in=[queued_judge.pk for queued_judge in queued_judges]).delete()
+            judge_ids = [queued_judge.user_id for queued_judge in queued_judges]
+            transaction.on_commit(lambda: metrics.judges_left_queue(len(judge_ids), 'seated'))
+            transaction.on_commit(lambda: session_state.set_in_room(
+                judge_ids, session_state.JUDGE, room.id, room.activated_date))
+            return [queued_judge.group_name for queued_judge in queued_judges]
+
+    def cancel(self, connection_id):
+        with transaction.atomic():
+            room = Room.objects.select_for_update().filter(
+                initial_connection_id=connection_id, activated_date=None
+            ).first()
+            if room is not None:
+                participant_ids = list(ParticipantConnection.objects.filter(room=room).values_list('user_id', flat=True))
+                self.get_queue().remove_seat(room.id)
+                room.remove_room()
+                transaction.on_commit(lambda: session_state.set_idle(*participant_ids))
+
+
+matchmaker = Matchmaker()
@@ -0,0 +1,176 @@
+import atexit
+import logging
+import queue
+import threading
+from django.conf import settings
+from django.db import DatabaseError, close_old_connections, transaction
+from django.db.models import Q
+from .models import Room
+from .transcript_cache import transcript_cache
+
+logger = logging.getLogger(__name__)
+
+
+class MessageBuffer:
+    # Write-behind for chat messages. A message gets its sequence number up
+    # front from the shared cache, is broadcast straight away and is inserted
+    # later in batches by a flusher thread, one per worker, which also moves
+    # the room's sequence counter up in the same transaction. Messages added inside a transaction are
+    # queued once it commits, so a rolled back send never reaches the buffer.
+    # When the queue is full the sender writes the pending batches itself,
+    # outside its own transaction, so a slow database slows senders down
+    # instead of growing the buffer. Whatever is left is flushed at exit.
+
+    def __init__(self, max_size=None, batch_size=None, flush_interval=None, background=True):
+        self.max_size = max_size
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.background = background
+        self.pending = None
+        self.thread = None
+        self.start_lock = threading.Lock()
+        self.flush_lock = threading.Lock()
+        self.wake = threading.Event()
+        self.stopping = threading.Event()
+
+    def get_max_size(self):
+        return self.max_size or settings.MESSAGE_BUFFER_MAX_SIZE
+
+    def get_batch_size(self):
+        return self.batch_size or settings.MESSAGE_BATCH_SIZE
+
+    def get_flush_interval(self):
+        return self.flush_interval or settings.MESSAGE_FLUSH_INTERVAL
+
+    def start(self):
+        with self.start_lock:
+            if self.pending is None:
+                self.pending = queue.Queue(self.get_max_size())
+            if self.background and self.thread is None:
+                self.thread = threading.Thread(target=self.run, name='message-buffer', daemon=True)
+                self.thread.start()
+                atexit.register(self.stop)
+
+    def add(self, message, transcript, formatted_message):
+        if transaction.get_connection().in_atomic_block:
+            transaction.on_commit(lambda: self.add(message, transcript, formatted_message))
+            return
+        if self.pending is None:
+            self.start()
+        entry = (message, transcript, formatted_message)
+        while True:
+            try:
+                self.pending.put_nowait(entry)
+                break
+            except queue.Full:
+                self.flush()
+        if self.pending.qsize() >= self.get_batch_size():
+            self.wake.set()
+
+    def run(self):
+        while not self.stopping.is_set():
+            self.wake.wait(self.get_flush_interval())
+            self.wake.clear()
+            try:
+                self.flush()
+            except Exception:
+                logger.exception("Message buffer flush failed")
+
+    def stop(self, timeout=5):
+        self.stopping.set()
+        self.wake.set()
+        if self.thread is not None:
+            self.thread.join(timeout)
+        self.flush()
+
+    def pending_count(self):
+        return self.pending.qsize() if self.pending is not None else 0
+
+    def flush(self):
+        if self.pending is None:
+            return 0
+        written = 0
+        with self.flush_lock:
+            while True:
+                batch = self.take(self.get_batch_size())
+                if not batch:
+                    return written
+                close_old_connections()
+                written += self.write(batch)
+
+    def take(self, limit):
+        batch = []
+        while len(batch) < limit:
+            try:
+                batch.append(self.pending.get_nowait())
+            except queue.Empty:
+                break
+        return batch
+
+    def write(self, batch):
+        by_model = {}
+        for entry in batch:
+            by_model.setdefault(type(entry[0]), []).append(entry)
+        written = 0
+        for model, entries in by_model.items():
+            messages = [message for message, _, _ in entries]
+            try:
+                with transaction.atomic():
+                    model.objects.bulk_create(messages)
+                    self.advance_sequences(model, messages)
+                    if any(message.pk is None for message in messages):
+                        self.load_ids(model, messages)
+            except DatabaseError:
+                logger.exception("Batched insert of %d %s rows failed, writing them one by one", len(entries), model.__name__)
+                entries = self.write_each(entries)
+            self.saved(entries)
+            written += len(entries)
+        return written
+
+    def write_each(self, entries):
+        saved = []
+        for entry in entries:
+            model = type(entry[0])
+            message = entry[0]
+            message.pk = None
+            try:
+                with transaction.atomic():
+                    message.save()
+                    self.advance_sequences(model, [message])
+            except DatabaseError:
+                logger.exception("Dropped %s %s of room %s", type(message).__name__, message.sequence, message.room_id)
+                continue
+            saved.append(entry)
+        return saved
+
+    def advance_sequences(self, model, messages):
+        heads = {}
+        for message in messages:
+            heads[message.room_id] = max(heads.get(message.room_id, 0), message.sequence)
+        for room_id, sequence in heads.items():
+            Room.advance_message_sequence(room_id, model.sequence_field, sequence)
+
+    def load_ids(self, model, messages):
+        # Backends that cannot return ids from a bulk insert leave pk unset;
+        # one lookup by (room, sequence) fills them in.
+        sequences = {}
+        for message in messages:
+            sequences.setdefault(message.room_id, []).append(message.sequence)
+        lookup = Q()
+        for room_id, room_sequences in sequences.items():
+            lookup |= Q(room=room_id, sequence__in=room_sequences)
+        ids = {(row['room_id'], row['sequence']): row['id']
+               for row in model.objects.filter(lookup).values('room_id', 'sequence', 'id')}
+        for message in messages:
+            message.pk = ids.get((message.room_id, message.sequence))
+
+    def saved(self, entries):
+        # A row the id lookup could not find is reread with its room instead.
+        for message, transcript, formatted_message in entries:
+            if message.pk is None:
+                transcript_cache.invalidate(message.room_id, streams=(transcript.stream,))
+            else:
+                transcript.append(message.room_id, dict(formatted_message, id=message.pk))
+
+
+message_buffer = MessageBuffer()
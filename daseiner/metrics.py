@@ -0,0 +1,193 @@
+import threading
+import time
+from .instrumentation import Histogram, BUCKET_BOUNDS, executors
+
+# Counters and gauges are kept per process and moved once the transition they
+# track has committed, so a scrape never touches the database. Sum them across
+# workers: a room opened on one worker and paired on another leaves +1 and -1
+# open rooms behind, which add up. A restarted worker forgets its share, so the
+# room and judge gauges drift until the next deploy restarts every worker.
+
+
+class Metric:
+    kind = None
+
+    def __init__(self, name, help_text, label=None):
+        self.name = name
+        self.help_text = help_text
+        self.label = label
+        self.values = {}
+        self.lock = threading.Lock()
+
+    def inc(self, amount=1, label_value=None):
+        with self.lock:
+            self.values[label_value] = self.values.get(label_value, 0) + amount
+
+    def dec(self, amount=1, label_value=None):
+        self.inc(-amount, label_value)
+
+    def series_name(self, label_value):
+        if self.label is None:
+            return self.name
+        return f'{self.name}{{{self.label}="{label_value}"}}'
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.help_text}', f'# TYPE {self.name} {self.kind}']
+        with self.lock:
+            values = dict(self.values)
+        if self.label is None and not values:
+            values = {None: 0}
+        for label_value, value in sorted(values.items(), key=lambda item: str(item[0])):
+            lines.append(f'{self.series_name(label_value)} {value}')
+        return lines
+
+
+class Counter(Metric):
+    kind = 'counter'
+
+
+class Gauge(Metric):
+    kind = 'gauge'
+
+
+class Timer:
+    kind = 'histogram'
+
+    def __init__(self, name, help_text):
+        self.name = name
+        self.help_text = help_text
+        self.histogram = Histogram()
+        self.lock = threading.Lock()
+
+    def observe(self, seconds):
+        with self.lock:
+            self.histogram.record(seconds)
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.help_text}', f'# TYPE {self.name} {self.kind}']
+        with self.lock:
+            lines.extend(histogram_samples(self.name, self.histogram))
+        return lines
+
+
+def histogram_samples(name, histogram, labels=''):
+    lines = []
+    prefix = f'{labels},' if labels else ''
+    suffix = f'{{{labels}}}' if labels else ''
+    cumulative = 0
+    for bound, bucket in zip(BUCKET_BOUNDS, histogram.buckets):
+        cumulative += bucket
+        lines.append(f'{name}_bucket{{{prefix}le="{bound:g}"}} {cumulative}')
+    lines.append(f'{name}_bucket{{{prefix}le="+Inf"}} {histogram.count}')
+    lines.append(f'{name}_sum{suffix} {histogram.total}')
+    lines.append(f'{name}_count{suffix} {histogram.count}')
+    return lines
+
+
+class ExecutorCollector:
+    # Reads the counters each database executor lane keeps for itself.
+
+    gauges = [
+        ('daseiner_db_executor_threads', 'gauge', 'threads', 'Threads available for sync database work'),
+        ('daseiner_db_executor_running', 'gauge', 'running', 'Sync hops running on the executor'),
+        ('daseiner_db_executor_waiting', 'gauge', 'waiting', 'Sync hops waiting for a free thread'),
+        ('daseiner_db_executor_hops_total', 'counter', 'submitted', 'Sync hops submitted to the executor'),
+        ('daseiner_db_executor_saturated_total', 'counter', 'saturated', 'Sync hops submitted while every thread was taken'),
+    ]
+
+    def render(self):
+        snapshots = {lane: executor.stats.snapshot() for lane, executor in sorted(executors.items())}
+        lines = []
+        for name, kind, key, help_text in self.gauges:
+            lines.extend([f'# HELP {name} {help_text}', f'# TYPE {name} {kind}'])
+            for lane, snapshot in snapshots.items():
+                lines.append(f'{name}{{lane="{lane}"}} {snapshot[key]}')
+        name = 'daseiner_db_executor_queue_wait_seconds'
+        lines.extend([f'# HELP {name} Time sync hops waited for a thread', f'# TYPE {name} histogram'])
+        for lane, executor in sorted(executors.items()):
+            with executor.stats.lock:
+                lines.extend(histogram_samples(name, executor.stats.queue_wait, f'lane="{lane}"'))
+        return lines
+
+
+rooms_opened = Counter('daseiner_rooms_opened_total', 'Rooms created for a waiting participant')
+rooms_removed = Counter('daseiner_rooms_removed_total', 'Open rooms dropped before a second participant arrived')
+rooms_activated = Counter('daseiner_rooms_activated_total', 'Rooms paired with a second participant')
+pairing_latency_seconds = Timer('daseiner_pairing_latency_seconds', 'Time a participant waited in the queue before being paired')
+rooms_terminated = Counter('daseiner_rooms_terminated_total', 'Rooms closed by a participant')
+judges_queued = Counter('daseiner_judges_queued_total', 'Judges added to the room queue')
+judges_dequeued = Counter('daseiner_judges_dequeued_total', 'Judges taken off the room queue, seated or left', label='reason')
+rooms_open = Gauge('daseiner_rooms_open', 'Rooms waiting for a second participant')
+rooms_active = Gauge('daseiner_rooms_active', 'Paired rooms that have not been terminated')
+waiting_judges = Gauge('daseiner_waiting_judges', 'Judges queued for a room')
+websocket_connections = Gauge('daseiner_websocket_connections', 'Open websocket connections', label='consumer')
+group_send_seconds = Timer('daseiner_group_send_seconds', 'Time spent in channel layer group_send')
+channel_layer_deliveries = Counter(
+    'daseiner_channel_layer_deliveries_total', 'Channel layer deliveries by path: local, remote publish or relayed', label='path')
+
+registry = [
+    rooms_opened,
+    rooms_removed,
+    rooms_activated,
+    pairing_latency_seconds,
+    rooms_terminated,
+    judges_queued,
+    judges_dequeued,
+    rooms_open,
+    rooms_active,
+    waiting_judges,
+    websocket_connections,
+    group_send_seconds,
+    channel_layer_deliveries,
+    ExecutorCollector(),
+]
+
+
+def room_opened():
+    rooms_opened.inc()
+    rooms_open.inc()
+
+def room_removed():
+    rooms_removed.inc()
+    rooms_open.dec()
+
+def room_activated():
+    rooms_activated.inc()
+    rooms_open.dec()
+    rooms_active.inc()
+
+def room_terminated(was_open):
+    rooms_terminated.inc()
+    (rooms_open if was_open else rooms_active).dec()
+
+def judge_queued():
+    judges_queued.inc()
+    waiting_judges.inc()
+
+def judges_left_queue(count, reason):
+    judges_dequeued.inc(count, label_value=reason)
+    waiting_judges.dec(count)
+
+
+class MetricsConsumerMixin:
+    async def websocket_connect(self, message):
+        websocket_connections.inc(label_value=type(self).__name__)
+        await super().websocket_connect(message)
+
+    async def websocket_disconnect(self, message):
+        websocket_connections.dec(label_value=type(self).__name__)
+        await super().websocket_disconnect(message)
+
+    async def group_send(self, group_name, event):
+        started = time.perf_counter()
+        try:
+            await self.channel_layer.group_send(group_name, event)
+        finally:
+            group_send_seconds.observe(time.perf_counter() - started)
+
+
+def render():
+    lines = []
+    for metric in registry:
+        lines.extend(metric.render())
+    return '\n'.join(lines) + '\n'
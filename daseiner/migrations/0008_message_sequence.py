@@ -0,0 +1,54 @@
+# Generated by Django 3.0.3 on 2026-10-18 12:00
+
+from django.db import migrations, models
+
+
+def backfill_message_sequences(apps, schema_editor):
+    Room = apps.get_model('daseiner', 'Room')
+    ParticipantMessage = apps.get_model('daseiner', 'ParticipantMessage')
+    JudgeMessage = apps.get_model('daseiner', 'JudgeMessage')
+    for room in Room.objects.all():
+        participant_messages = ParticipantMessage.objects.filter(
+            participant_connection__room=room).order_by('create_date')
+        for sequence, message in enumerate(participant_messages, start=1):
+            message.sequence = sequence
+            message.save(update_fields=['sequence'])
+        judge_messages = JudgeMessage.objects.filter(
+            judge_connection__room=room).order_by('create_date')
+        for sequence, message in enumerate(judge_messages, start=1):
+            message.sequence = sequence
+            message.save(update_fields=['sequence'])
+        room.participant_message_sequence = participant_messages.count()
+        room.judge_message_sequence = judge_messages.count()
+        room.save(update_fields=['participant_message_sequence', 'judge_message_sequence'])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('daseiner', '0007_waitingjudge'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='room',
+            name='participant_message_sequence',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='room',
+            name='judge_message_sequence',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='participantmessage',
+            name='sequence',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='judgemessage',
+            name='sequence',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.RunPython(backfill_message_sequences, migrations.RunPython.noop),
+    ]
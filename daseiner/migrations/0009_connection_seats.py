@@ -0,0 +1,86 @@
+# Generated by Django 3.0.3 on 2026-10-18 12:00
+
+from django.db import migrations, models
+
+
+SEATED_MODELS = (
+    ('ParticipantConnection', 'ParticipantMessage', 'participant_connection', 2),
+    ('JudgeConnection', 'JudgeMessage', 'judge_connection', 5),
+)
+
+
+def assign_seats(apps, schema_editor):
+    # Rooms hit by the old join race can hold a user twice or more connections
+    # than seats, which the constraints below would reject. Each user keeps
+    # their earliest connection, which takes over the messages of the others;
+    # connections past the seat limit are dropped along with their messages.
+    for model_name, message_model_name, message_field, seat_limit in SEATED_MODELS:
+        Connection = apps.get_model('daseiner', model_name)
+        Message = apps.get_model('daseiner', message_model_name)
+        seats, kept, dropped = {}, {}, []
+        for connection in Connection.objects.order_by('room_id', 'create_date', 'id'):
+            first = kept.get((connection.room_id, connection.user_id))
+            if first is not None:
+                Message.objects.filter(**{message_field: connection}).update(**{message_field: first})
+                dropped.append(connection.pk)
+                continue
+            seat = seats.get(connection.room_id, 0) + 1
+            if seat > seat_limit:
+                dropped.append(connection.pk)
+                continue
+            seats[connection.room_id] = seat
+            kept[(connection.room_id, connection.user_id)] = connection
+            connection.seat = seat
+            connection.save(update_fields=['seat'])
+        Connection.objects.filter(pk__in=dropped).delete()
+    if schema_editor.connection.vendor == 'postgresql':
+        # Flush the deferred foreign key checks queued by the moves above so
+        # the constraints below may alter the tables in this transaction.
+        schema_editor.execute('SET CONSTRAINTS ALL IMMEDIATE')
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('daseiner', '0008_message_sequence'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='participantconnection',
+            name='seat',
+            field=models.PositiveSmallIntegerField(default=1),
+            preserve_default=False,
+        ),
+        migrations.AddField(
+            model_name='judgeconnection',
+            name='seat',
+            field=models.PositiveSmallIntegerField(default=1),
+            preserve_default=False,
+        ),
+        migrations.RunPython(assign_seats, migrations.RunPython.noop),
+        migrations.AddConstraint(
+            model_name='participantconnection',
+            constraint=models.UniqueConstraint(fields=('room', 'user'), name='participant_connection_room_user'),
+        ),
+        migrations.AddConstraint(
+            model_name='participantconnection',
+            constraint=models.UniqueConstraint(fields=('room', 'seat'), name='participant_connection_room_seat'),
+        ),
+        migrations.AddConstraint(
+            model_name='participantconnection',
+            constraint=models.CheckConstraint(check=models.Q(('seat__gte', 1), ('seat__lte', 2)), name='participant_connection_seat_range'),
+        ),
+        migrations.AddConstraint(
+            model_name='judgeconnection',
+            constraint=models.UniqueConstraint(fields=('room', 'user'), name='judge_connection_room_user'),
+        ),
+        migrations.AddConstraint(
+            model_name='judgeconnection',
+            constraint=models.UniqueConstraint(fields=('room', 'seat'), name='judge_connection_room_seat'),
+        ),
+        migrations.AddConstraint(
+            model_name='judgeconnection',
+            constraint=models.CheckConstraint(check=models.Q(('seat__gte', 1), ('seat__lte', 5)), name='judge_connection_seat_range'),
+        ),
+    ]
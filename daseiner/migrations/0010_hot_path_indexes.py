@@ -0,0 +1,80 @@
+# Generated by Django 3.0.3 on 2026-10-18 12:00
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+def backfill_message_rooms(apps, schema_editor):
+    ParticipantConnection = apps.get_model('daseiner', 'ParticipantConnection')
+    JudgeConnection = apps.get_model('daseiner', 'JudgeConnection')
+    ParticipantMessage = apps.get_model('daseiner', 'ParticipantMessage')
+    JudgeMessage = apps.get_model('daseiner', 'JudgeMessage')
+    ParticipantMessage.objects.update(room_id=models.Subquery(
+        ParticipantConnection.objects.filter(pk=models.OuterRef('participant_connection_id')).values('room_id')[:1]
+    ))
+    JudgeMessage.objects.update(room_id=models.Subquery(
+        JudgeConnection.objects.filter(pk=models.OuterRef('judge_connection_id')).values('room_id')[:1]
+    ))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('daseiner', '0009_connection_seats'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='participantmessage',
+            name='room',
+            field=models.ForeignKey(db_index=False, null=True, on_delete=django.db.models.deletion.CASCADE, to='daseiner.Room'),
+        ),
+        migrations.AddField(
+            model_name='judgemessage',
+            name='room',
+            field=models.ForeignKey(db_index=False, null=True, on_delete=django.db.models.deletion.CASCADE, to='daseiner.Room'),
+        ),
+        migrations.RunPython(backfill_message_rooms, migrations.RunPython.noop),
+        migrations.AlterField(
+            model_name='participantmessage',
+            name='room',
+            field=models.ForeignKey(db_index=False, on_delete=django.db.models.deletion.CASCADE, to='daseiner.Room'),
+        ),
+        migrations.AlterField(
+            model_name='judgemessage',
+            name='room',
+            field=models.ForeignKey(db_index=False, on_delete=django.db.models.deletion.CASCADE, to='daseiner.Room'),
+        ),
+        migrations.AddIndex(
+            model_name='room',
+            index=models.Index(condition=models.Q(is_open=True), fields=['create_date'], name='room_open_created_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='room',
+            index=models.Index(fields=['is_open', 'termination_date'], name='room_open_terminated_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='room',
+            index=models.Index(fields=['initial_connection_id'], name='room_initial_connection_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='participantmessage',
+            index=models.Index(fields=['room', 'create_date', 'id'], name='pmsg_room_created_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='participantmessage',
+            index=models.Index(fields=['room', 'sequence'], name='pmsg_room_sequence_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='judgemessage',
+            index=models.Index(fields=['room', 'create_date', 'id'], name='jmsg_room_created_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='judgemessage',
+            index=models.Index(fields=['room', 'sequence'], name='jmsg_room_sequence_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='waitingjudge',
+            index=models.Index(fields=['create_date'], name='waiting_judge_created_idx'),
+        ),
+    ]
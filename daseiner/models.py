@@ -1,9 +1,21 @@
-from django.db import models
+from django.db import models, transaction, IntegrityError
 from django.contrib.auth.models import User
+from django.core.cache import cache
 from django.utils import timezone
 import uuid
-from channels.layers import get_channel_layer
-from asgiref.sync import async_to_sync
+from .transcript_cache import transcript_cache
+from . import session_state
+from . import tickets
+from . import metrics
+
+MESSAGE_SEQUENCE_TIMEOUT = 24 * 60 * 60
+
+PARTICIPANT_CONNECTION_LIMIT = 2
+JUDGE_CONNECTION_LIMIT = 5
+
+CONNECTED = 'connected'
+ROOM_FULL = 'room_full'
+ALREADY_CONNECTED = 'already_connected'
 
 class Question(models.Model):
     id = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False)
@@ -24,93 +36,211 @@ class Room(models.Model):
     initial_connection_id = models.UUIDField(editable=False)
     termination_date = models.DateTimeField(default=None, blank=True, null=True)
     question = models.ForeignKey(Question, default=None,on_delete=models.CASCADE)
+    participant_message_sequence = models.PositiveIntegerField(default=0)
+    judge_message_sequence = models.PositiveIntegerField(default=0)
 
     def __str__(self):
         return f"Open: {self.is_open}"
 
+    @classmethod
+    def next_message_sequence(cls, room_id, sequence_field):
+        # The UPDATE holds the row lock until the surrounding transaction ends,
+        # so concurrent senders in the same room always read distinct values.
+        with transaction.atomic():
+            cls.objects.filter(pk=room_id).update(**{sequence_field: models.F(sequence_field) + 1})
+            return cls.objects.filter(pk=room_id).values_list(sequence_field, flat=True).get()
+
+    @classmethod
+    def reserve_message_sequence(cls, room_id, sequence_field):
+        # Write-behind senders count in the shared cache instead, seeded from
+        # the room row, so a send costs no database round trip. The flusher
+        # moves the row up in the transaction that inserts the batch; the
+        # counter is only reseeded once a room has been quiet for a day, long
+        # after its buffered messages were written.
+        key = f'{sequence_field}:{room_id}'
+        try:
+            return cache.incr(key)
+        except ValueError:
+            current = cls.objects.filter(pk=room_id).values_list(sequence_field, flat=True).get()
+            cache.add(key, current, MESSAGE_SEQUENCE_TIMEOUT)
+            return cache.incr(key)
+
+    @classmethod
+    def advance_message_sequence(cls, room_id, sequence_field, sequence):
+        cls.objects.filter(pk=room_id, **{f'{sequence_field}__lt': sequence}).update(**{sequence_field: sequence})
+
     def set_room_match(self):
         self.is_open = False
         self.activated_date = timezone.now()
         self.save()
+        transaction.on_commit(metrics.room_activated)
 
     def close_room(self):
+        room_id = self.id
+        was_open = self.is_open
         if not self.termination_date:
             self.termination_date = timezone.now()
             self.save()
+            user_ids = [
+                *self.participantconnection_set.values_list('user_id', flat=True),
+                *self.judgeconnection_set.values_list('user_id', flat=True)
+            ]
+            transaction.on_commit(lambda: tickets.set_room_terminated(room_id))
+            transaction.on_commit(lambda: metrics.room_terminated(was_open))
+            transaction.on_commit(lambda: session_state.set_idle(*user_ids))
+        transaction.on_commit(lambda: transcript_cache.invalidate(room_id))
 
     def remove_room(self):
+        room_id = self.id
         self.delete()
+        transaction.on_commit(lambda: transcript_cache.invalidate(room_id))
+        if self.is_open:
+            transaction.on_commit(metrics.room_removed)
 
     class Meta:
         db_table = 'room'
+        indexes = [
+            models.Index(fields=['create_date'], name='room_open_created_idx', condition=models.Q(is_open=True)),
+            models.Index(fields=['is_open', 'termination_date'], name='room_open_terminated_idx'),
+            models.Index(fields=['initial_connection_id'], name='room_initial_connection_idx'),
+        ]
+
+class SeatedConnection:
+    # Room capacity and one connection per user are enforced by the seat
+    # constraints on each table. A new connection takes the lowest free seat
+    # and lets the database reject it if another connection got there first.
+
+    seat_limit = None
 
-class ParticipantConnection(models.Model):
+    def save(self, *args, **kwargs):
+        if self._state.adding and self.seat is None:
+            return self.take_seat()
+        super().save(*args, **kwargs)
+
+    def take_seat(self):
+        connections = type(self).objects.filter(room_id=self.room_id)
+        taken_seats = set(connections.values_list('seat', flat=True))
+        for seat in range(1, self.seat_limit + 1):
+            if seat in taken_seats:
+                continue
+            try:
+                with transaction.atomic():
+                    self.seat = seat
+                    super().save(force_insert=True)
+                return CONNECTED
+            except IntegrityError:
+                self.seat = None
+                if connections.filter(user_id=self.user_id).exists():
+                    return ALREADY_CONNECTED
+        return ROOM_FULL
+
+class ParticipantConnection(SeatedConnection, models.Model):
     user = models.ForeignKey(User, on_delete=models.CASCADE)
     room = models.ForeignKey(Room, on_delete=models.CASCADE)
     create_date = models.DateTimeField(default=timezone.now, editable=False)
     is_current_speaker = models.BooleanField(default=False)
+    seat = models.PositiveSmallIntegerField()
+
+    seat_limit = PARTICIPANT_CONNECTION_LIMIT
 
     def __str__(self):
         return f"Room:{self.room.id} | User: {self.user.username}"
     
-    def save(self, *args, **kwargs):
-        participant_set_count = self.room.participantconnection_set.all().count()
-        participant_connection_limit_met = True if participant_set_count == 2 else False
-
-        existing_save = self.room.participantconnection_set.filter(room=self.room, user=self.user)
-        is_exisisting_save = True if existing_save.count() == 1 else False
-
-        if is_exisisting_save or not participant_connection_limit_met:
-            super(ParticipantConnection, self).save(*args, **kwargs)
-        else:
-            return None
-    
     class Meta:
         db_table = 'participant_connection'
-
-class JudgeConnection(models.Model):
+        constraints = [
+            models.UniqueConstraint(fields=['room', 'user'], name='participant_connection_room_user'),
+            models.UniqueConstraint(fields=['room', 'seat'], name='participant_connection_room_seat'),
+            models.CheckConstraint(
+                check=models.Q(seat__gte=1, seat__lte=PARTICIPANT_CONNECTION_LIMIT),
+                name='participant_connection_seat_range'
+            ),
+        ]
+
+class JudgeConnection(SeatedConnection, models.Model):
     room = models.ForeignKey(Room, on_delete=models.CASCADE)
     user = models.ForeignKey(User, on_delete=models.CASCADE)
     create_date = models.DateTimeField(default=timezone.now, editable=False)
+    seat = models.PositiveSmallIntegerField()
 
-    def save(self, *args,**kwargs):
-        judge_connection_limit_met = True if self.room.judgeconnection_set.all().count() == 5 else False
-        existing_save = self.room.judgeconnection_set.filter(room=self.room, user=self.user)
-        is_exisisting_save = True if existing_save.count() == 1 else False
-
-        if is_exisisting_save or not judge_connection_limit_met:
-            super(JudgeConnection, self).save(*args, **kwargs)
-            return True
-        else:
-            return False
+    seat_limit = JUDGE_CONNECTION_LIMIT
 
     def __str__(self):
         return f"Room:{self.room.id} | User: {self.user.username}"
 
     class Meta:
         db_table = 'judge_connection'
+        constraints = [
+            models.UniqueConstraint(fields=['room', 'user'], name='judge_connection_room_user'),
+            models.UniqueConstraint(fields=['room', 'seat'], name='judge_connection_room_seat'),
+            models.CheckConstraint(
+                check=models.Q(seat__gte=1, seat__lte=JUDGE_CONNECTION_LIMIT),
+                name='judge_connection_seat_range'
+            ),
+        ]
 
 class ParticipantMessage(models.Model):
     participant_connection = models.ForeignKey(ParticipantConnection, on_delete=models.CASCADE)
+    # Copied from the connection so transcript reads are one range scan.
+    room = models.ForeignKey(Room, on_delete=models.CASCADE, db_index=False)
     body = models.CharField(default='', max_length=2500)
     create_date = models.DateTimeField(default=timezone.now, editable=False)
+    sequence = models.PositiveIntegerField(default=0)
+
+    sequence_field = 'participant_message_sequence'
 
     def __str__(self):
         return self.body
 
+    def assign_sequence(self, write_behind=False):
+        if self.room_id is None:
+            self.room_id = self.participant_connection.room_id
+        if not self.sequence:
+            allocate = Room.reserve_message_sequence if write_behind else Room.next_message_sequence
+            self.sequence = allocate(self.room_id, self.sequence_field)
+
+    def save(self, *args, **kwargs):
+        with transaction.atomic():
+            self.assign_sequence()
+            super(ParticipantMessage, self).save(*args, **kwargs)
+
     class Meta:
         db_table = 'participant_message'
+        indexes = [
+            models.Index(fields=['room', 'create_date', 'id'], name='pmsg_room_created_idx'),
+            models.Index(fields=['room', 'sequence'], name='pmsg_room_sequence_idx'),
+        ]
 
 class JudgeMessage(models.Model):
     judge_connection = models.ForeignKey(JudgeConnection, on_delete=models.CASCADE)
+    room = models.ForeignKey(Room, on_delete=models.CASCADE, db_index=False)
     body = models.CharField(default='', max_length=1000)
     create_date = models.DateTimeField(default=timezone.now, editable=False)
+    sequence = models.PositiveIntegerField(default=0)
+
+    sequence_field = 'judge_message_sequence'
 
     def __str__(self):
         return self.body
 
+    def assign_sequence(self, write_behind=False):
+        if self.room_id is None:
+            self.room_id = self.judge_connection.room_id
+        if not self.sequence:
+            allocate = Room.reserve_message_sequence if write_behind else Room.next_message_sequence
+            self.sequence = allocate(self.room_id, self.sequence_field)
+
+    def save(self, *args, **kwargs):
+        with transaction.atomic():
+            self.assign_sequence()
+            super(JudgeMessage, self).save(*args, **kwargs)
+
     class Meta:
         db_table = 'judge_message'
+        indexes = [
+            models.Index(fields=['room', 'create_date', 'id'], name='jmsg_room_created_idx'),
+            models.Index(fields=['room', 'sequence'], name='jmsg_room_sequence_idx'),
+        ]
 
 class Profile(models.Model):
     id = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False)
@@ -139,12 +269,8 @@ class WaitingJudge(models.Model):
     def __str__(self):
         return str(self.create_date)
 
-    def send_room_id(self, message):
-        channel_layer = get_channel_layer()
-        async_to_sync(channel_layer.group_send)(
-        self.group_name,
-        {'type': 'room_id', 'room_id': str(message)}
-    )
-
     class Meta:
         db_table = 'waiting_judge'
+        indexes = [
+            models.Index(fields=['create_date'], name='waiting_judge_created_idx'),
+        ]
@@ -0,0 +1,54 @@
+import random
+import threading
+import uuid
+from django.core.cache import cache
+from .models import Question
+
+DECK_VERSION_KEY = 'question_deck:version'
+ROOM_QUESTION_TIMEOUT = 24 * 60 * 60
+
+
+def room_question_key(room_id):
+    return f'room_question:{room_id}'
+
+
+class QuestionDeck:
+    # Every worker keeps the question titles and a shuffled draw pile in
+    # memory. Edits to questions bump a shared version in the cache, which
+    # makes every worker reload on its next draw or lookup.
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.version = None
+        self.titles = {}
+        self.pile = []
+
+    def refresh(self):
+        version = cache.get(DECK_VERSION_KEY)
+        if version is None:
+            version = uuid.uuid4().hex
+            cache.add(DECK_VERSION_KEY, version, None)
+            version = cache.get(DECK_VERSION_KEY, version)
+        with self.lock:
+            if version != self.version:
+                self.titles = dict(Question.objects.values_list('id', 'title'))
+                self.pile = []
+                self.version = version
+
+    def draw(self):
+        self.refresh()
+        with self.lock:
+            if not self.pile:
+                self.pile = list(self.titles)
+                random.shuffle(self.pile)
+            return self.pile.pop() if self.pile else None
+
+    def title(self, question_id):
+        self.refresh()
+        return self.titles.get(question_id)
+
+    def invalidate(self):
+        cache.set(DECK_VERSION_KEY, uuid.uuid4().hex, None)
+
+
+question_deck = QuestionDeck()
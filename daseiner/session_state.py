@@ -0,0 +1,50 @@
+from django.core.cache import cache
+
+IDLE = 'idle'
+QUEUED = 'queued'
+IN_ROOM = 'in_room'
+
+PARTICIPANT = 'participant'
+JUDGE = 'judge'
+
+SESSION_STATE_TIMEOUT = 60 * 60
+
+
+def session_state_key(user_id):
+    return f'session_state:{user_id}'
+
+def set_idle(*user_ids):
+    cache.set_many({session_state_key(user_id): {'state': IDLE} for user_id in user_ids}, SESSION_STATE_TIMEOUT)
+
+def set_queued(user_id, role):
+    cache.set(session_state_key(user_id), {'state': QUEUED, 'role': role}, SESSION_STATE_TIMEOUT)
+
+def set_in_room(user_ids, role, room_id, activated_date):
+    state = {'state': IN_ROOM, 'role': role, 'roomId': room_id, 'activatedDate': activated_date}
+    cache.set_many({session_state_key(user_id): state for user_id in user_ids}, SESSION_STATE_TIMEOUT)
+
+def get_state(user_id):
+    state = cache.get(session_state_key(user_id))
+    if state is None:
+        state = load_state(user_id)
+        # add, not set: a transition committed while we were loading must win
+        # over the snapshot we read, so prefer whatever landed meanwhile.
+        if not cache.add(session_state_key(user_id), state, SESSION_STATE_TIMEOUT):
+            state = cache.get(session_state_key(user_id), state)
+    return state
+
+def load_state(user_id):
+    # Only used when the cache has no record for the user, e.g. after a flush.
+    from .models import WaitingJudge, ParticipantConnection, JudgeConnection
+
+    if WaitingJudge.objects.filter(user=user_id).exists():
+        return {'state': QUEUED, 'role': JUDGE}
+    if ParticipantConnection.objects.filter(user=user_id, room__is_open=True).exists():
+        return {'state': QUEUED, 'role': PARTICIPANT}
+    for role, connections in ((JUDGE, JudgeConnection.objects), (PARTICIPANT, ParticipantConnection.objects)):
+        room = connections.filter(
+            user=user_id, room__termination_date=None, room__is_open=False
+        ).values('room_id', 'room__activated_date').first()
+        if room is not None:
+            return {'state': IN_ROOM, 'role': role, 'roomId': room['room_id'], 'activatedDate': room['room__activated_date']}
+    return {'state': IDLE}
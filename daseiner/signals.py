@@ -0,0 +1,18 @@
+from django.db.models.signals import post_save, post_delete
+from django.dispatch import receiver
+from django.contrib.auth.models import User
+from daseiner_proj.socketmiddleware import invalidate_user
+from .models import Question
+from .questions import question_deck
+
+
+@receiver(post_save, sender=Question)
+@receiver(post_delete, sender=Question)
+def invalidate_question_deck(sender, **kwargs):
+    question_deck.invalidate()
+
+
+@receiver(post_save, sender=User)
+def invalidate_deactivated_user(sender, instance, **kwargs):
+    if not instance.is_active:
+        invalidate_user(instance.id)
@@ -2,26 +2,42 @@ import celery
 from celery import task
 from daseiner_proj.celery import app
 from celery.utils.log import get_task_logger
-from daseiner.models import Room, ParticipantConnection
+from daseiner.models import Room
+from daseiner.turns import get_turn_schedule
+from daseiner.frames import group_event, room_group_name
 from django.db import close_old_connections
-import time
+from channels.layers import get_channel_layer
+from asgiref.sync import async_to_sync
 
 logger = get_task_logger(__name__)
 
+# Fire just after each boundary so the schedule already reports the new turn.
+TURN_CHANGE_SLACK_SECONDS = 1
+
 @app.task
 def change_turns(room_id):
+    # Each turn change is its own ETA task, so a debate holds no worker while
+    # it waits for the next switch.
+    close_old_connections()
+    schedule = get_turn_schedule(room_id)
+    if schedule:
+        change_turn.apply_async((room_id,), countdown=schedule.seconds_until_next_turn() + TURN_CHANGE_SLACK_SECONDS)
+
+@app.task
+def change_turn(room_id):
     close_old_connections()
-    participant_connections = ParticipantConnection.objects.filter(room=room_id)
-    participant_one = participant_connections[0]
-    participant_two = participant_connections[1]
-    room = Room.objects.get(pk=room_id)
-    counter = 0
-    while(counter <= 6 and not room.termination_date):
-        close_old_connections()
-        time.sleep(120)
-        close_old_connections()
-        participant_one.is_current_speaker = True if not participant_one.is_current_speaker else False
-        participant_two.is_current_speaker = True if not participant_two.is_current_speaker else False
-        participant_one.save()
-        participant_two.save()
-        counter += 1
+    room = Room.objects.filter(pk=room_id).values('termination_date').first()
+    schedule = get_turn_schedule(room_id)
+    if room is None or room['termination_date'] or schedule is None:
+        return
+
+    send_turn_changed(room_id, schedule.to_json())
+
+    seconds_until_next_turn = schedule.seconds_until_next_turn()
+    if seconds_until_next_turn is not None:
+        change_turn.apply_async((room_id,), countdown=seconds_until_next_turn + TURN_CHANGE_SLACK_SECONDS)
+
+def send_turn_changed(room_id, turn_state):
+    channel_layer = get_channel_layer()
+    event = group_event('turn_changed', dict(turn_state, contentType='turn_changed'))
+    async_to_sync(channel_layer.group_send)(room_group_name(room_id), event)
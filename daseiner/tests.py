@@ -1,3 +1,929 @@
-from django.test import TestCase
+from django.test import TestCase, TransactionTestCase, override_settings
+from rest_framework.test import APIClient
+from django.contrib.auth.models import User
+from django.db import connection, transaction
+from django.db.migrations.executor import MigrationExecutor
+from .models import Question, Room, ParticipantConnection, JudgeConnection, ParticipantMessage, JudgeMessage, WaitingJudge
+from .models import CONNECTED, ROOM_FULL, ALREADY_CONNECTED
+from .consumers import ParticipantChatConsumer
+from . import transcripts
+from .matchmaking import Matchmaker, InMemorySeatQueue, DatabaseSeatQueue, RedisSeatQueue, Seat
+from .questions import QuestionDeck
+from . import session_state
+from . import tickets
+from .turns import TurnSchedule, TURN_LENGTH_SECONDS, TURN_CHANGES
+from .message_buffer import MessageBuffer
+from .transcript_cache import TranscriptCache
+from . import transcript_cache as transcript_cache_module
+from .instrumentation import ExecutorStats, InstrumentedCommandMixin, command_stats
+from . import frames
+from . import tasks
+from . import metrics
+from .channel_layers import HybridChannelLayer, ShardedChannelLayer
+from channels.layers import InMemoryChannelLayer
+from daseiner_proj import socketmiddleware
+from rest_framework_simplejwt.tokens import AccessToken
+from channels.testing import WebsocketCommunicator
+from asgiref.sync import async_to_sync
+from unittest import mock
+import asyncio
+import datetime
+import json
+import threading
+import time
+import uuid
 
-# Create your tests here.
+
+class TranscriptLoaderTests(TransactionTestCase):
+    def setUp(self):
+        question = Question.objects.create(title="Is a hot dog a sandwich?")
+        self.room = Room.objects.create(initial_connection_id=uuid.uuid4(), question=question)
+        participants = [User.objects.create_user(username=f"participant{i}", password="pw") for i in range(2)]
+        judges = [User.objects.create_user(username=f"judge{i}", password="pw") for i in range(3)]
+        participant_connections = [ParticipantConnection(user=user, room=self.room) for user in participants]
+        for connection in participant_connections:
+            connection.save()
+        judge_connections = [JudgeConnection(user=user, room=self.room) for user in judges]
+        for connection in judge_connections:
+            connection.save()
+        for i in range(20):
+            ParticipantMessage(participant_connection=participant_connections[i % 2], body=f"argument {i}").save()
+            JudgeMessage(judge_connection=judge_connections[i % 3], body=f"note {i}").save()
+
+    def test_load_page_is_one_query(self):
+        with self.assertNumQueries(1):
+            participant_messages, has_more = transcripts.participant_transcript.load_page(self.room.id, limit=15)
+        with self.assertNumQueries(1):
+            judge_messages, _ = transcripts.judge_transcript.load_page(self.room.id, limit=50)
+        self.assertEqual(len(participant_messages), 15)
+        self.assertTrue(has_more)
+        self.assertEqual(participant_messages[-1]['content'], "argument 19")
+        self.assertEqual(participant_messages[-1]['username'], "participant1")
+        self.assertEqual(len(judge_messages), 20)
+        self.assertEqual(judge_messages[0]['username'], "judge0")
+
+    def test_load_since_and_load_all_are_one_query(self):
+        with self.assertNumQueries(1):
+            missed = transcripts.participant_transcript.load_since(self.room.id, 18)
+        with self.assertNumQueries(1):
+            everything = transcripts.judge_transcript.load_all(self.room.id)
+        self.assertEqual([message['sequence'] for message in missed], [19, 20])
+        self.assertEqual(len(everything), 20)
+
+    def test_cached_transcript_serves_reads_and_appends_without_queries(self):
+        transcripts.participant_transcript.load_page(self.room.id)
+        connection = ParticipantConnection.objects.select_related('user').filter(room=self.room).first()
+        message = ParticipantMessage(participant_connection=connection, body="rebuttal")
+        message.save()
+        transcripts.participant_transcript.append(self.room.id, transcripts.message_to_json(message, connection.user))
+        with self.assertNumQueries(0):
+            latest, _ = transcripts.participant_transcript.load_page(self.room.id, limit=1)
+            missed = transcripts.participant_transcript.load_since(self.room.id, 20)
+        self.assertEqual(latest[0]['content'], "rebuttal")
+        self.assertEqual(missed[0]['sequence'], 21)
+
+        self.room.close_room()
+        with self.assertNumQueries(1):
+            transcripts.participant_transcript.load_page(self.room.id)
+
+    def test_warm_reads_make_one_shared_cache_round_trip(self):
+        transcripts.participant_transcript.load_page(self.room.id)
+        shared = mock.Mock(wraps=transcript_cache_module.cache)
+        with mock.patch.object(transcript_cache_module, 'cache', shared):
+            page, _ = transcripts.participant_transcript.load_page(self.room.id, limit=1)
+        self.assertEqual(page[0]['sequence'], 20)
+        self.assertEqual([call[0] for call in shared.method_calls], ['get_many'])
+
+
+class PaginationTests(TestCase):
+    def setUp(self):
+        question = Question.objects.create(title="Is a hot dog a sandwich?")
+        self.room = Room.objects.create(initial_connection_id=uuid.uuid4(), question=question)
+        user = User.objects.create_user(username="participant", password="pw")
+        connection = ParticipantConnection(user=user, room=self.room)
+        connection.save()
+        # Messages two and three, and five and six, share a timestamp.
+        start = datetime.datetime(2020, 6, 1, 12, tzinfo=datetime.timezone.utc)
+        for i, second in enumerate([0, 1, 1, 2, 3, 3, 4]):
+            ParticipantMessage(
+                participant_connection=connection, body=f"argument {i}", create_date=start + datetime.timedelta(seconds=second)
+            ).save()
+
+    def walk(self, direction, cursor_of, cursor=None):
+        pages = []
+        while True:
+            page, has_more = transcripts.participant_transcript.load_page(self.room.id, limit=2, **{direction: cursor})
+            pages.append(([message['content'][-1] for message in page], has_more))
+            if not has_more:
+                return pages
+            cursor = transcripts.parse_cursor(cursor_of(page[0] if direction == 'before' else page[-1]))
+
+    def check_both_directions(self, cursor_of):
+        self.assertEqual(self.walk('before', cursor_of), [
+            (['5', '6'], True), (['3', '4'], True), (['1', '2'], True), (['0'], False)
+        ])
+        oldest = transcripts.participant_transcript.load_all(self.room.id)[0]
+        self.assertEqual(self.walk('after', cursor_of, transcripts.parse_cursor(cursor_of(oldest))), [
+            (['1', '2'], True), (['3', '4'], True), (['5', '6'], False)
+        ])
+
+    def test_timestamp_cursors_page_through_ties(self):
+        for cache_enabled in (False, True):
+            with self.subTest(cache_enabled=cache_enabled), self.settings(TRANSCRIPT_CACHE_ENABLED=cache_enabled):
+                self.check_both_directions(lambda message: {'timestamp': message['timestamp'], 'id': message['id']})
+
+    def test_sequence_cursors_page_in_sequence_order(self):
+        for cache_enabled in (False, True):
+            with self.subTest(cache_enabled=cache_enabled), self.settings(TRANSCRIPT_CACHE_ENABLED=cache_enabled):
+                self.check_both_directions(lambda message: {'timestamp': message['timestamp'], 'id': None, 'sequence': message['sequence']})
+
+
+class MessageSequenceTests(TransactionTestCase):
+    def setUp(self):
+        question = Question.objects.create(title="Is a hot dog a sandwich?")
+        self.room = Room.objects.create(initial_connection_id=uuid.uuid4(), question=question)
+        self.other_room = Room.objects.create(initial_connection_id=uuid.uuid4(), question=question)
+        self.users = [User.objects.create_user(username=f"participant{i}", password="pw") for i in range(2)]
+        for user in self.users:
+            ParticipantConnection(user=user, room=self.room).save()
+
+    def communicator(self, user):
+        async def scope_user():
+            return user
+        url_route = {'kwargs': {'room_name': str(self.room.id)}}
+        application = lambda scope: ParticipantChatConsumer(dict(scope, user=scope_user(), url_route=url_route))
+        return WebsocketCommunicator(application, f'/ws/chat/{self.room.id}/')
+
+    def command(self, command, **data):
+        return json.dumps(dict(data, command=command, room=str(self.room.id)))
+
+    def test_sequences_count_up_per_room_and_stream(self):
+        participant = ParticipantConnection.objects.get(user=self.users[0])
+        judge = JudgeConnection(user=User.objects.create_user(username="judge", password="pw"), room=self.room)
+        judge.save()
+        other = ParticipantConnection(user=self.users[1], room=self.other_room)
+        other.save()
+        for i in range(3):
+            ParticipantMessage(participant_connection=participant, body=f"argument {i}").save()
+            JudgeMessage(judge_connection=judge, body=f"note {i}").save()
+        ParticipantMessage(participant_connection=other, body="elsewhere").save()
+
+        self.assertEqual(list(ParticipantMessage.objects.filter(room=self.room).order_by('id').values_list('sequence', flat=True)), [1, 2, 3])
+        self.assertEqual(list(JudgeMessage.objects.filter(room=self.room).order_by('id').values_list('sequence', flat=True)), [1, 2, 3])
+        self.assertEqual(ParticipantMessage.objects.get(room=self.other_room).sequence, 1)
+
+    @override_settings(CHAT_FULL_HISTORY_BROADCAST=False)
+    def test_broadcasts_carry_only_the_new_message_and_missed_ones_are_refetched(self):
+        async_to_sync(self.run_reconnecting_participant)()
+
+    async def run_reconnecting_participant(self):
+        speaker, listener = self.communicator(self.users[0]), self.communicator(self.users[1])
+        self.assertTrue((await speaker.connect())[0])
+        self.assertTrue((await listener.connect())[0])
+
+        await speaker.send_to(text_data=self.command('new_messages', messages="opening"))
+        for communicator in (speaker, listener):
+            event = json.loads(await communicator.receive_from())
+            self.assertEqual([message['content'] for message in event['participantMessages']], ["opening"])
+            self.assertEqual(event['participantSequence'], 1)
+        await listener.disconnect()
+
+        for body in ("rebuttal", "closing"):
+            await speaker.send_to(text_data=self.command('new_messages', messages=body))
+            self.assertEqual(json.loads(await speaker.receive_from())['participantMessages'][0]['content'], body)
+
+        listener = self.communicator(self.users[1])
+        await listener.connect()
+        await listener.send_to(text_data=self.command('fetch_missed_messages', participantSequence=1))
+        missed = json.loads(await listener.receive_from())['participantMessages']
+        self.assertEqual([(message['sequence'], message['content']) for message in missed], [(2, "rebuttal"), (3, "closing")])
+        await listener.disconnect()
+        await speaker.disconnect()
+
+
+class MatchmakerTests(TransactionTestCase):
+    def setUp(self):
+        Question.objects.create(title="Should cereal count as soup?")
+        self.matchmaker = Matchmaker(InMemorySeatQueue())
+        self.users = [User.objects.create_user(username=f"debater{i}", password="pw") for i in range(3)]
+
+    def test_pairs_waiting_participants_once(self):
+        pairings = metrics.pairing_latency_seconds.histogram.count
+        first = self.matchmaker.find_match(self.users[0], uuid.uuid4())
+        again = self.matchmaker.find_match(self.users[0], uuid.uuid4())
+        second = self.matchmaker.find_match(self.users[1], uuid.uuid4())
+        third = self.matchmaker.find_match(self.users[2], uuid.uuid4())
+
+        self.assertFalse(first.matched)
+        self.assertEqual(again.room.id, first.room.id)
+        self.assertTrue(second.matched)
+        self.assertEqual(second.room.id, first.room.id)
+        self.assertIsNotNone(second.latency)
+        self.assertFalse(third.matched)
+        self.assertNotEqual(third.room.id, first.room.id)
+        self.assertEqual(ParticipantConnection.objects.filter(room=first.room).count(), 2)
+        self.assertEqual(metrics.pairing_latency_seconds.histogram.count, pairings + 1)
+        self.assertIn('daseiner_pairing_latency_seconds_count', metrics.render())
+
+    def test_transitions_keep_session_state_current(self):
+        waiting = self.matchmaker.find_match(self.users[0], uuid.uuid4())
+        self.assertEqual(session_state.get_state(self.users[0].id), {'state': session_state.QUEUED, 'role': 'participant'})
+        self.matchmaker.find_match(self.users[1], uuid.uuid4())
+        with self.assertNumQueries(0):
+            state = session_state.get_state(self.users[0].id)
+        self.assertEqual(state['state'], session_state.IN_ROOM)
+        self.assertEqual(state['roomId'], waiting.room.id)
+
+        Room.objects.get(pk=waiting.room.id).close_room()
+        self.assertEqual(session_state.get_state(self.users[1].id), {'state': session_state.IDLE})
+
+    def test_cancel_removes_unpaired_room_and_seat(self):
+        connection_id = uuid.uuid4()
+        waiting = self.matchmaker.find_match(self.users[0], connection_id)
+        self.matchmaker.cancel(connection_id)
+        self.assertFalse(Room.objects.filter(pk=waiting.room.id).exists())
+        self.assertFalse(self.matchmaker.find_match(self.users[1], uuid.uuid4()).matched)
+
+    def test_assign_judge_prefers_room_with_fewest_judges(self):
+        debaters = self.users + [User.objects.create_user(username="debater3", password="pw")]
+        rooms = []
+        for first, second in (debaters[0:2], debaters[2:4]):
+            rooms.append(self.matchmaker.find_match(first, uuid.uuid4()).room)
+            self.matchmaker.find_match(second, uuid.uuid4())
+        judges = [User.objects.create_user(username=f"judge{i}", password="pw") for i in range(10)]
+        JudgeConnection(room=rooms[0], user=judges[0]).save()
+
+        self.assertEqual(self.matchmaker.assign_judge(judges[1]).id, rooms[1].id)
+        self.assertEqual(self.matchmaker.assign_judge(debaters[0]).id, rooms[1].id)
+        for judge in judges[2:9]:
+            self.assertIsNotNone(self.matchmaker.assign_judge(judge))
+        self.assertIsNone(self.matchmaker.assign_judge(judges[9]))
+        self.assertEqual(JudgeConnection.objects.filter(room=rooms[0]).count(), 5)
+        self.assertEqual(JudgeConnection.objects.filter(room=rooms[1]).count(), 5)
+
+    def test_dispatch_waiting_judges_fills_free_seats_in_queue_order(self):
+        judges = [User.objects.create_user(username=f"judge{i}", password="pw") for i in range(6)]
+        for judge in judges:
+            WaitingJudge.objects.create(user=judge, group_name=f"judging_{judge.username}")
+        self.matchmaker.find_match(self.users[0], uuid.uuid4())
+        room = self.matchmaker.find_match(self.users[1], uuid.uuid4()).room
+
+        group_names = self.matchmaker.dispatch_waiting_judges(room)
+
+        self.assertEqual(group_names, [f"judging_judge{i}" for i in range(5)])
+        self.assertEqual(JudgeConnection.objects.filter(room=room).count(), 5)
+        self.assertEqual(list(WaitingJudge.objects.values_list('user__username', flat=True)), ["judge5"])
+
+
+class RacingSeatQueue(DatabaseSeatQueue):
+    # Holds each searcher after its first look at the queue until the other
+    # has looked too, so both find it empty.
+
+    def __init__(self):
+        self.barrier = threading.Barrier(2, timeout=5)
+        self.raced = threading.local()
+
+    def first_open_seat(self, user):
+        seat = super().first_open_seat(user)
+        if not getattr(self.raced, 'done', False):
+            self.raced.done = True
+            self.barrier.wait()
+        return seat
+
+
+class DatabaseSeatQueueTests(TransactionTestCase):
+    def test_searchers_meeting_an_empty_queue_open_one_room(self):
+        if connection.vendor != 'postgresql':
+            self.skipTest("the open-room lock is a Postgres advisory lock")
+        Question.objects.create(title="Is a pop tart a ravioli?")
+        matchmaker = Matchmaker(RacingSeatQueue())
+        users = [User.objects.create_user(username=f"searcher{i}", password="pw") for i in range(2)]
+        results = []
+
+        def search(user):
+            try:
+                results.append(matchmaker.find_match(user, uuid.uuid4()))
+            finally:
+                connection.close()
+
+        threads = [threading.Thread(target=search, args=(user,)) for user in users]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(Room.objects.count(), 1)
+        self.assertEqual(sorted(result.matched for result in results), [False, True])
+
+
+class RedisSeatQueueTests(TestCase):
+    def setUp(self):
+        self.queue = RedisSeatQueue()
+        try:
+            self.queue.redis.ping()
+        except Exception:
+            self.skipTest("no Redis server to run against")
+        prefix = f'test:{uuid.uuid4().hex}'
+        self.queue.key, self.queue.processing_key, self.queue.open_room_key = (
+            f'{prefix}:seats', f'{prefix}:processing', f'{prefix}:open_room')
+        self.users = [User(id=i, username=f"searcher{i}") for i in (1, 2, 3)]
+
+    def seat(self, user):
+        return Seat(uuid.uuid4(), user.id, datetime.datetime.now(datetime.timezone.utc))
+
+    def test_second_searcher_waits_for_the_first_ones_seat(self):
+        self.assertIsNone(self.queue.claim_seat(self.users[0]))
+        claimed = []
+        waiter = threading.Thread(target=lambda: claimed.append(self.queue.claim_seat(self.users[1])))
+        waiter.start()
+        time.sleep(0.1)
+        self.assertEqual(claimed, [])
+
+        seat = self.seat(self.users[0])
+        self.queue.add_seat(seat)
+        waiter.join(1)
+        self.assertEqual(claimed[0].room_id, str(seat.room_id))
+        self.queue.seat_taken(claimed[0])
+        self.assertIsNone(self.queue.claim_seat(self.users[2]))
+
+    def test_seat_of_an_uncommitted_pairing_returns_to_the_queue(self):
+        self.assertIsNone(self.queue.claim_seat(self.users[0]))
+        seat = self.seat(self.users[0])
+        self.queue.add_seat(seat)
+        self.assertEqual(self.queue.claim_seat(self.users[1]).room_id, str(seat.room_id))
+
+        with mock.patch('daseiner.matchmaking.SEAT_LEASE_SECONDS', 0.05):
+            time.sleep(0.1)
+            self.assertEqual(self.queue.claim_seat(self.users[2]).room_id, str(seat.room_id))
+
+
+class ConnectionSeatMigrationTests(TransactionTestCase):
+    before = [('daseiner', '0008_message_sequence')]
+    after = [('daseiner', '0009_connection_seats')]
+
+    def migrate(self, targets):
+        executor = MigrationExecutor(connection)
+        executor.migrate(targets)
+        return executor.loader.project_state(targets).apps
+
+    def tearDown(self):
+        executor = MigrationExecutor(connection)
+        executor.migrate(executor.loader.graph.leaf_nodes())
+
+    def test_raced_rooms_are_trimmed_before_the_seat_constraints(self):
+        apps = self.migrate(self.before)
+        HistoricalUser = apps.get_model('auth', 'User')
+        HistoricalRoom = apps.get_model('daseiner', 'Room')
+        Participant = apps.get_model('daseiner', 'ParticipantConnection')
+        Judge = apps.get_model('daseiner', 'JudgeConnection')
+        Message = apps.get_model('daseiner', 'ParticipantMessage')
+        question = apps.get_model('daseiner', 'Question').objects.create(title="Is soup a drink?")
+        room = HistoricalRoom.objects.create(initial_connection_id=uuid.uuid4(), question=question)
+        users = [HistoricalUser.objects.create(username=f"crowd{i}") for i in range(8)]
+        start = datetime.datetime(2020, 6, 1, 12, tzinfo=datetime.timezone.utc)
+        at = lambda seconds: start + datetime.timedelta(seconds=seconds)
+        first = Participant.objects.create(room=room, user=users[0], create_date=at(0))
+        again = Participant.objects.create(room=room, user=users[0], create_date=at(1))
+        Participant.objects.create(room=room, user=users[1], create_date=at(2))
+        Participant.objects.create(room=room, user=users[2], create_date=at(3))
+        Message.objects.create(participant_connection=again, body="said twice")
+        for i in range(7):
+            Judge.objects.create(room=room, user=users[1 + i], create_date=at(10 + i))
+        Judge.objects.create(room=room, user=users[1], create_date=at(20))
+
+        apps = self.migrate(self.after)
+        participants = apps.get_model('daseiner', 'ParticipantConnection').objects.filter(room=room.id).order_by('seat')
+        self.assertEqual([(c.user.username, c.seat) for c in participants], [("crowd0", 1), ("crowd1", 2)])
+        message = apps.get_model('daseiner', 'ParticipantMessage').objects.get(body="said twice")
+        self.assertEqual(message.participant_connection_id, first.id)
+        judges = apps.get_model('daseiner', 'JudgeConnection').objects.filter(room=room.id).order_by('seat')
+        self.assertEqual([(c.user.username, c.seat) for c in judges], [(f"crowd{i}", i) for i in range(1, 6)])
+
+
+class QuestionDeckTests(TestCase):
+    def test_draws_every_question_before_repeating(self):
+        questions = [Question.objects.create(title=f"Motion {i}") for i in range(4)]
+        deck = QuestionDeck()
+        deck.refresh()
+        with self.assertNumQueries(0):
+            drawn = [deck.draw() for _ in questions]
+        self.assertCountEqual(drawn, [question.id for question in questions])
+
+        questions[0].title = "Amended motion"
+        questions[0].save()
+        self.assertEqual(deck.title(questions[0].id), "Amended motion")
+
+
+class TurnScheduleTests(TestCase):
+    def test_speaker_alternates_from_activation_and_then_stops(self):
+        activated = datetime.datetime(2020, 6, 1, 12, 0, tzinfo=datetime.timezone.utc)
+        schedule = TurnSchedule(activated, 1, 2)
+        at = lambda seconds: activated + datetime.timedelta(seconds=seconds)
+
+        self.assertEqual(schedule.current_speaker_id(at(0)), 1)
+        self.assertEqual(schedule.seconds_until_next_turn(at(30)), TURN_LENGTH_SECONDS - 30)
+        self.assertEqual(schedule.current_speaker_id(at(TURN_LENGTH_SECONDS)), 2)
+        self.assertEqual(schedule.remaining_turns(at(TURN_LENGTH_SECONDS)), TURN_CHANGES - 1)
+        finished = at(TURN_LENGTH_SECONDS * (TURN_CHANGES + 3))
+        self.assertEqual(schedule.remaining_turns(finished), 0)
+        self.assertIsNone(schedule.seconds_until_next_turn(finished))
+        self.assertEqual(schedule.current_speaker_id(finished), 2)
+
+
+class ChangeTurnTests(TransactionTestCase):
+    def test_turn_changes_stop_once_the_room_is_terminated(self):
+        question = Question.objects.create(title="Is a calzone a pizza?")
+        room = Room.objects.create(initial_connection_id=uuid.uuid4(), question=question)
+        for i in range(2):
+            ParticipantConnection(user=User.objects.create_user(username=f"speaker{i}", password="pw"), room=room).save()
+        room.set_room_match()
+
+        with mock.patch.object(tasks, 'send_turn_changed') as send, \
+                mock.patch.object(tasks.change_turn, 'apply_async') as reschedule:
+            tasks.change_turn(room.id)
+            self.assertEqual(send.call_count, 1)
+            self.assertEqual(reschedule.call_count, 1)
+
+            room.close_room()
+            tasks.change_turn(room.id)
+            self.assertEqual(send.call_count, 1)
+            self.assertEqual(reschedule.call_count, 1)
+
+
+class SeatedConnectionTests(TestCase):
+    def test_seats_are_limited_and_unique_per_user(self):
+        question = Question.objects.create(title="Is water wet?")
+        room = Room.objects.create(initial_connection_id=uuid.uuid4(), question=question)
+        users = [User.objects.create_user(username=f"user{i}", password="pw") for i in range(3)]
+
+        first = ParticipantConnection(user=users[0], room=room)
+        self.assertEqual(first.take_seat(), CONNECTED)
+        self.assertEqual(ParticipantConnection(user=users[0], room=room).take_seat(), ALREADY_CONNECTED)
+        self.assertEqual(ParticipantConnection(user=users[1], room=room).take_seat(), CONNECTED)
+        self.assertEqual(ParticipantConnection(user=users[2], room=room).take_seat(), ROOM_FULL)
+
+        first.is_current_speaker = True
+        with self.assertNumQueries(1):
+            first.save()
+
+
+class HotPathIndexTests(TestCase):
+    def setUp(self):
+        if connection.vendor == 'postgresql':
+            with connection.cursor() as cursor:
+                cursor.execute("SET enable_seqscan TO off")
+        question = Question.objects.create(title="Are hot dogs sandwiches?")
+        self.room = Room.objects.create(initial_connection_id=uuid.uuid4(), question=question)
+
+    def assertUsesIndex(self, queryset, index_name):
+        self.assertIn(index_name, queryset.explain())
+
+    def test_transcript_reads_range_scan_the_room_indexes(self):
+        self.assertUsesIndex(
+            ParticipantMessage.objects.filter(room=self.room).order_by('-create_date', '-id')[:51],
+            'pmsg_room_created_idx'
+        )
+        self.assertUsesIndex(
+            JudgeMessage.objects.filter(room=self.room, sequence__gt=10).order_by('sequence'),
+            'jmsg_room_sequence_idx'
+        )
+
+    def test_room_lookup_by_initial_connection_uses_index(self):
+        self.assertUsesIndex(
+            Room.objects.filter(initial_connection_id=self.room.initial_connection_id),
+            'room_initial_connection_idx'
+        )
+
+
+class RoomTicketTests(TransactionTestCase):
+    def test_ticket_is_bound_to_user_and_follows_termination(self):
+        question = Question.objects.create(title="Is cereal soup?")
+        room = Room.objects.create(initial_connection_id=uuid.uuid4(), question=question)
+        room.set_room_match()
+        ticket = tickets.make_ticket(room.id, tickets.JUDGE, 7, room.activated_date.isoformat())
+
+        self.assertIsNone(tickets.read_ticket(ticket, 8))
+        self.assertIsNone(tickets.read_ticket(ticket[:-2], 7))
+        self.assertEqual(tickets.read_ticket(ticket, 7)['roomId'], str(room.id))
+        self.assertFalse(tickets.is_room_terminated(room.id))
+        room.close_room()
+        with self.assertNumQueries(0):
+            self.assertTrue(tickets.is_room_terminated(room.id))
+
+    def test_rolled_back_close_leaves_shared_state_alone(self):
+        question = Question.objects.create(title="Is a pop tart a ravioli?")
+        room = Room.objects.create(initial_connection_id=uuid.uuid4(), question=question)
+        room.set_room_match()
+        user = User.objects.create_user(username="stayer", password="pw")
+        ParticipantConnection(user=user, room=room).save()
+        session_state.set_in_room([user.id], session_state.PARTICIPANT, room.id, room.activated_date)
+
+        with self.assertRaises(RuntimeError):
+            with transaction.atomic():
+                Room.objects.get(pk=room.id).close_room()
+                raise RuntimeError
+        self.assertFalse(tickets.is_room_terminated(room.id))
+        self.assertEqual(session_state.get_state(user.id)['state'], session_state.IN_ROOM)
+
+        with transaction.atomic():
+            Room.objects.get(pk=room.id).close_room()
+            self.assertFalse(tickets.is_room_terminated(room.id))
+        self.assertTrue(tickets.is_room_terminated(room.id))
+        self.assertEqual(session_state.get_state(user.id)['state'], session_state.IDLE)
+
+    def test_cache_fill_does_not_overwrite_a_transition_landing_meanwhile(self):
+        user = User.objects.create_user(username="late-loader", password="pw")
+        session_state.cache.delete(session_state.session_state_key(user.id))
+        load_state = session_state.load_state
+
+        def racing_load(user_id):
+            state = load_state(user_id)
+            session_state.set_queued(user_id, session_state.JUDGE)
+            return state
+
+        with mock.patch.object(session_state, 'load_state', racing_load):
+            self.assertEqual(session_state.get_state(user.id), {'state': session_state.QUEUED, 'role': session_state.JUDGE})
+        self.assertEqual(session_state.get_state(user.id)['state'], session_state.QUEUED)
+
+    def test_termination_flag_is_not_overwritten_by_a_stale_read(self):
+        question = Question.objects.create(title="Is a hot dog a taco?")
+        room = Room.objects.create(initial_connection_id=uuid.uuid4(), question=question)
+        room.set_room_match()
+        tickets.cache.delete(tickets.room_terminated_key(room.id))
+        stale = Room.objects.filter(pk=room.id).values('termination_date').first()
+
+        def racing_first(queryset):
+            tickets.set_room_terminated(room.id)
+            return stale
+
+        with mock.patch('django.db.models.query.QuerySet.first', racing_first):
+            self.assertTrue(tickets.is_room_terminated(room.id))
+        self.assertTrue(tickets.is_room_terminated(room.id))
+
+    def test_tickets_containing_double_dashes_validate_as_tickets(self):
+        question = Question.objects.create(title="Is a taco a sandwich?")
+        room = Room.objects.create(initial_connection_id=uuid.uuid4(), question=question)
+        room.set_room_match()
+        user = User.objects.create_user(username="ticket-holder", password="pw")
+        ticket = next(
+            ticket for ticket in (
+                tickets.make_ticket(room.id, tickets.PARTICIPANT, user.id, f'2020-06-01T12:00:{i % 60:02d}.{i:06d}+00:00')
+                for i in range(5000)
+            ) if '--' in ticket
+        )
+        client = APIClient()
+        client.force_authenticate(user)
+        response = client.get(f'/api/validate-room/{ticket}')
+        self.assertTrue(response.data['isValid'])
+
+
+class SocketAuthTests(TransactionTestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(username="speaker", password="pw")
+
+    def connect(self, token):
+        return async_to_sync(socketmiddleware.get_user)(str(token))
+
+    def test_expired_token_is_dropped_from_the_claims_cache(self):
+        token = AccessToken.for_user(self.user)
+        token.set_exp(lifetime=datetime.timedelta(seconds=1))
+        self.assertEqual(self.connect(token), self.user)
+
+        time.sleep(max(0, token['exp'] - time.time()) + 0.1)
+        self.assertFalse(self.connect(token).is_authenticated)
+
+    def test_deactivated_user_is_turned_away_by_every_worker(self):
+        token = AccessToken.for_user(self.user)
+        self.assertEqual(self.connect(token), self.user)
+        self.assertIsNotNone(socketmiddleware.user_cache.get(self.user.id))
+
+        stale = socketmiddleware.user_cache.get(self.user.id)
+        self.user.is_active = False
+        self.user.save()
+        self.assertIsNone(socketmiddleware.user_cache.get(self.user.id))
+        # Another worker's copy is still cached; the shared marker overrides it.
+        socketmiddleware.user_cache.set(self.user.id, stale)
+        self.assertFalse(self.connect(token).is_authenticated)
+
+
+class MessageBufferTests(TransactionTestCase):
+    def setUp(self):
+        question = Question.objects.create(title="Is water wet?")
+        self.room = Room.objects.create(initial_connection_id=uuid.uuid4(), question=question)
+        self.user = User.objects.create_user(username="speaker", password="pw")
+        self.connection = ParticipantConnection(user=self.user, room=self.room)
+        self.connection.save()
+
+    def add(self, buffer, body):
+        message = ParticipantMessage(participant_connection=self.connection, body=body)
+        message.assign_sequence(write_behind=True)
+        buffer.add(message, transcripts.participant_transcript, transcripts.message_to_json(message, self.user))
+
+    def test_full_buffer_is_written_by_the_sender(self):
+        buffer = MessageBuffer(max_size=3, batch_size=2, flush_interval=60, background=False)
+
+        for i in range(5):
+            self.add(buffer, f"point {i}")
+        self.assertEqual(ParticipantMessage.objects.filter(room=self.room).count(), 3)
+        self.assertEqual(buffer.pending_count(), 2)
+
+        self.assertEqual(buffer.flush(), 2)
+        saved = ParticipantMessage.objects.filter(room=self.room).order_by('sequence')
+        self.assertEqual([message.sequence for message in saved], [1, 2, 3, 4, 5])
+        self.assertEqual(saved.last().body, "point 4")
+        self.room.refresh_from_db()
+        self.assertEqual(self.room.participant_message_sequence, 5)
+
+    @override_settings(TRANSCRIPT_CACHE_ENABLED=True)
+    def test_sends_take_no_queries_and_flushed_ids_reach_the_transcript(self):
+        buffer = MessageBuffer(max_size=10, batch_size=10, flush_interval=60, background=False)
+        transcripts.participant_transcript.load_all(self.room.id)
+        self.add(buffer, "opening")
+        with self.assertNumQueries(0):
+            self.add(buffer, "rebuttal")
+
+        with mock.patch('daseiner.message_buffer.transcript_cache.invalidate') as invalidate:
+            buffer.flush()
+        invalidate.assert_not_called()
+        saved = dict(ParticipantMessage.objects.filter(room=self.room).values_list('sequence', 'id'))
+        with self.assertNumQueries(0):
+            messages = transcripts.participant_transcript.load_all(self.room.id)
+        self.assertEqual([(message['sequence'], message['id']) for message in messages], sorted(saved.items()))
+        self.assertEqual(len(saved), 2)
+
+    def test_messages_are_queued_when_the_sender_commits(self):
+        buffer = MessageBuffer(max_size=1, batch_size=1, flush_interval=60, background=False)
+        with self.assertRaises(RuntimeError):
+            with transaction.atomic():
+                self.add(buffer, "withdrawn")
+                raise RuntimeError
+        self.assertEqual(buffer.pending_count(), 0)
+
+        with transaction.atomic():
+            self.add(buffer, "first")
+            self.add(buffer, "second")
+            self.assertEqual(buffer.pending_count(), 0)
+        self.assertEqual(buffer.pending_count(), 1)
+        self.assertEqual(list(ParticipantMessage.objects.filter(room=self.room).values_list('body', flat=True)), ["first"])
+
+
+class CursorTests(TestCase):
+    def test_cursors_without_an_id_page_by_sequence(self):
+        self.assertEqual(transcripts.parse_cursor({'timestamp': '2020-01-01 10:00:00', 'id': None, 'sequence': 7}), 7)
+        created, pk = transcripts.parse_cursor({'timestamp': '2020-01-01 10:00:00', 'id': '3'})
+        self.assertEqual((created.minute, pk), (0, 3))
+        for cursor in ({'id': 3}, {'timestamp': 'yesterday', 'id': 3}, {'id': None}, ['2020-01-01', 3]):
+            with self.assertRaises(transcripts.InvalidCursor):
+                transcripts.parse_cursor(cursor)
+
+    @override_settings(TRANSCRIPT_PAGE_SIZE=20, TRANSCRIPT_MAX_PAGE_SIZE=100)
+    def test_unusable_limits_fall_back_to_the_default_page(self):
+        for limit in ("ten", [10], {'n': 10}, "1e3", float('inf')):
+            with self.subTest(limit=limit):
+                self.assertEqual(transcripts.page_size({'limit': limit}), 20)
+        self.assertEqual(transcripts.page_size({'limit': "5"}), 5)
+        self.assertEqual(transcripts.page_size({'limit': 10000}), 100)
+        self.assertEqual(transcripts.page_size({}), 20)
+
+
+class RecordingSocket:
+    async def send(self, text_data=None, bytes_data=None, close=False):
+        pass
+
+
+class GreetingConsumer(InstrumentedCommandMixin, RecordingSocket):
+    async def greet(self, data):
+        await self.send(text_data="h\u00e9")
+
+    commands = {'greet': greet}
+
+
+class CommandStatsTests(TestCase):
+    def test_counts_bytes_and_buckets_unknown_commands(self):
+        consumer = GreetingConsumer()
+        async_to_sync(consumer.dispatch_command)({'command': 'greet'})
+        for command in ('greet2', 'greet3'):
+            with self.assertRaises(KeyError):
+                async_to_sync(consumer.dispatch_command)({'command': command})
+
+        snapshot = command_stats.snapshot()
+        self.assertEqual(snapshot['GreetingConsumer.greet']['bytesSent']['max'], 3)
+        self.assertEqual(snapshot['GreetingConsumer.unknown']['wallTime']['count'], 2)
+        self.assertEqual([key for key in snapshot if key.startswith('GreetingConsumer.')],
+                         ['GreetingConsumer.greet', 'GreetingConsumer.unknown'])
+
+
+class RoomMetricsTests(TransactionTestCase):
+    def gauge(self, metric):
+        return metric.values.get(None, 0)
+
+    def test_counters_and_gauges_follow_commits(self):
+        question = Question.objects.create(title="Is a straw one hole or two?")
+        abandoned = Room.objects.create(initial_connection_id=uuid.uuid4(), question=question)
+        paired = Room.objects.create(initial_connection_id=uuid.uuid4(), question=question)
+        removed, activated = self.gauge(metrics.rooms_removed), self.gauge(metrics.rooms_activated)
+        rooms_open, rooms_active = self.gauge(metrics.rooms_open), self.gauge(metrics.rooms_active)
+
+        with self.assertRaises(RuntimeError):
+            with transaction.atomic():
+                Room.objects.get(pk=abandoned.id).remove_room()
+                raise RuntimeError
+        self.assertEqual(self.gauge(metrics.rooms_removed), removed)
+        self.assertEqual(self.gauge(metrics.rooms_open), rooms_open)
+        Room.objects.get(pk=abandoned.id).remove_room()
+        paired.set_room_match()
+        self.assertEqual(self.gauge(metrics.rooms_removed), removed + 1)
+        self.assertEqual(self.gauge(metrics.rooms_activated), activated + 1)
+        self.assertEqual(self.gauge(metrics.rooms_open), rooms_open - 2)
+        self.assertEqual(self.gauge(metrics.rooms_active), rooms_active + 1)
+        paired.close_room()
+        self.assertEqual(self.gauge(metrics.rooms_active), rooms_active)
+
+    @override_settings(METRICS_SCRAPE_TOKEN="scrape-me", METRICS_ALLOWED_IPS=["10.0.0.9"])
+    def test_scrapes_need_the_token_or_an_allowed_address(self):
+        client = APIClient()
+        client.force_authenticate(User.objects.create_superuser(username="ops", password="pw", email="ops@example.com"))
+        self.assertEqual(client.get('/api/metrics').status_code, 403)
+
+        client = APIClient()
+        self.assertEqual(client.get('/api/metrics', HTTP_AUTHORIZATION="Bearer wrong").status_code, 403)
+        with self.assertNumQueries(0):
+            response = client.get('/api/metrics', HTTP_AUTHORIZATION="Bearer scrape-me")
+        self.assertEqual(response.status_code, 200)
+        samples = response.content.decode().splitlines()
+        for name in ('daseiner_rooms_open', 'daseiner_rooms_active', 'daseiner_waiting_judges'):
+            self.assertIn(f'# TYPE {name} gauge', samples)
+        self.assertEqual(client.get('/api/metrics', REMOTE_ADDR="10.0.0.9").status_code, 200)
+
+
+class ExecutorStatsTests(TestCase):
+    def test_counts_waiting_running_and_saturated_hops(self):
+        stats = ExecutorStats(threads=1)
+        first = stats.submit()
+        stats.start(first)
+        second = stats.submit()
+        cancelled = stats.submit()
+        stats.abandon(cancelled)
+        snapshot = stats.snapshot()
+        self.assertEqual((snapshot['running'], snapshot['waiting']), (1, 1))
+        self.assertEqual(snapshot['saturated'], 2)
+
+        stats.finish(first)
+        stats.start(second)
+        stats.abandon(second)
+        stats.finish(second)
+        snapshot = stats.snapshot()
+        self.assertEqual((snapshot['running'], snapshot['waiting']), (0, 0))
+        self.assertEqual(snapshot['queueWait']['count'], 2)
+
+
+class RoomGroupEventTests(TestCase):
+    def test_judge_chatter_stays_with_judges(self):
+        judge_note = frames.group_event('chat_message', {'contentType': 'new_message'}, frames.JUDGES)
+        argument = frames.group_event('chat_message', {'contentType': 'new_message'})
+        legacy = {'type': 'chat_message', 'data': {'contentType': 'new_message'}}
+
+        self.assertFalse(frames.visible_to(judge_note, frames.PARTICIPANTS))
+        self.assertTrue(frames.visible_to(judge_note, frames.JUDGES))
+        self.assertTrue(frames.visible_to(argument, frames.PARTICIPANTS))
+        self.assertTrue(frames.visible_to(legacy, frames.JUDGES))
+        self.assertEqual(frames.event_text(legacy), frames.event_text(argument))
+
+
+class HybridChannelLayerTests(TestCase):
+    def test_two_workers_share_groups_through_the_remote_layer(self):
+        async_to_sync(self.run_two_workers)()
+
+    async def run_two_workers(self):
+        redis = InMemoryChannelLayer()
+        first, second = HybridChannelLayer(remote=redis), HybridChannelLayer(remote=redis)
+        try:
+            participants = [await first.new_channel(), await first.new_channel()]
+            judge = await second.new_channel()
+            for layer, channel in [(first, participants[0]), (first, participants[1]), (second, judge)]:
+                await layer.group_add('room_chat_1', channel)
+
+            await first.group_send('room_chat_1', {'type': 'chat_message', 'text': 'opening'})
+            for layer, channel in [(first, participants[0]), (first, participants[1]), (second, judge)]:
+                message = await asyncio.wait_for(layer.receive(channel), 1)
+                self.assertEqual(message, {'type': 'chat_message', 'text': 'opening'})
+            self.assertEqual(first.deliveries, {'local': 2, 'remote': 1, 'relayed': 0})
+            self.assertEqual(second.deliveries['relayed'], 1)
+
+            await second.group_send('room_chat_1', {'type': 'chat_message', 'text': 'note'})
+            self.assertEqual((await asyncio.wait_for(second.receive(judge), 1))['text'], 'note')
+            self.assertEqual((await asyncio.wait_for(first.receive(participants[0]), 1))['text'], 'note')
+            with self.assertRaises(asyncio.TimeoutError):
+                await asyncio.wait_for(second.receive(judge), 0.05)
+            self.assertEqual(second.deliveries, {'local': 1, 'remote': 1, 'relayed': 1})
+        finally:
+            await first.close()
+            await second.close()
+
+
+class CountingChannelLayer(InMemoryChannelLayer):
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        self.published = []
+
+    async def send(self, channel, message):
+        self.published.append(message['type'])
+        await super().send(channel, message)
+
+    async def group_send(self, group, message):
+        self.published.append(message['type'])
+        await super().group_send(group, message)
+
+
+class HybridFastPathTests(TestCase):
+    def test_local_only_rooms_stay_off_the_remote_layer(self):
+        async_to_sync(self.run_settled_workers)()
+
+    async def run_settled_workers(self):
+        redis = CountingChannelLayer()
+        first, second = HybridChannelLayer(remote=redis, settle_delay=0), HybridChannelLayer(remote=redis, settle_delay=0)
+        try:
+            participant = await first.new_channel()
+            await first.group_add('room_chat_1', participant)
+            redis.published.clear()
+            await first.group_send('room_chat_1', {'type': 'chat_message', 'text': 'opening'})
+            self.assertEqual((await asyncio.wait_for(first.receive(participant), 1))['text'], 'opening')
+            self.assertEqual(redis.published, [])
+            self.assertEqual(first.deliveries['remote'], 0)
+
+            judge = await second.new_channel()
+            await second.group_add('room_chat_1', judge)
+            await asyncio.sleep(0.05)
+            redis.published.clear()
+            await first.group_send('room_chat_1', {'type': 'chat_message', 'text': 'rebuttal'})
+            self.assertEqual((await asyncio.wait_for(second.receive(judge), 1))['text'], 'rebuttal')
+            self.assertEqual(redis.published, ['chat_message'])
+
+            await second.group_discard('room_chat_1', judge)
+            await asyncio.sleep(0.05)
+            redis.published.clear()
+            await first.group_send('room_chat_1', {'type': 'chat_message', 'text': 'closing'})
+            self.assertEqual(redis.published, [])
+        finally:
+            await first.close()
+            await second.close()
+
+
+class ShardedChannelLayerTests(TestCase):
+    def test_groups_follow_their_shard_across_workers_and_rebalancing(self):
+        async_to_sync(self.run_two_workers)()
+
+    async def run_two_workers(self):
+        shards = {name: InMemoryChannelLayer() for name in ('a', 'b', 'c')}
+        first, second = ShardedChannelLayer(dict(shards)), ShardedChannelLayer(dict(shards))
+        rooms = [f'room_chat_{uuid.uuid4()}' for _ in range(40)]
+        self.assertEqual([first.shard_for_group(room) for room in rooms], [second.shard_for_group(room) for room in rooms])
+        self.assertEqual(len({first.shard_for_group(room) for room in rooms}), 3)
+        try:
+            participant, judge = await first.new_channel(), await second.new_channel()
+            for room in rooms:
+                await first.group_add(room, participant)
+                await second.group_add(room, judge)
+            searching = f'participant_searching_{uuid.uuid4()}'
+            await first.group_add(searching, participant)
+
+            await second.group_send(searching, {'type': 'room_id', 'room_id': 'paired'})
+            self.assertEqual((await asyncio.wait_for(first.receive(participant), 1))['room_id'], 'paired')
+
+            newcomer = InMemoryChannelLayer()
+            moved = [group for group in await first.add_shard('d', newcomer) if group != searching]
+            self.assertEqual(moved, await second.add_shard('d', newcomer))
+            self.assertTrue(0 < len(moved) < len(rooms))
+            for room in rooms:
+                await first.group_send(room, {'type': 'chat_message', 'text': room})
+                self.assertEqual((await asyncio.wait_for(first.receive(participant), 1))['text'], room)
+                self.assertEqual((await asyncio.wait_for(second.receive(judge), 1))['text'], room)
+        finally:
+            await first.close()
+            await second.close()
+
+
+class TranscriptCacheTests(TestCase):
+    def message(self, sequence):
+        return {
+            'id': sequence,
+            'username': 'debater',
+            'content': f'point {sequence}',
+            'timestamp': f'2020-06-01 12:00:0{sequence}+00:00',
+            'userid': 1,
+            'sequence': sequence
+        }
+
+    def test_worker_catches_up_on_appends_made_elsewhere(self):
+        room_id = uuid.uuid4()
+        first_worker, second_worker = TranscriptCache(), TranscriptCache()
+        second_worker.fill('participant', room_id, [self.message(sequence) for sequence in (1, 2, 3)])
+        first_worker.append('participant', room_id, self.message(4))
+        second_worker.append('participant', room_id, self.message(5))
+
+        transcript = second_worker.get('participant', room_id)
+        self.assertEqual([message['sequence'] for message in transcript.since(3)], [4, 5])
+        self.assertEqual(transcript.head, 5)
+        page, has_more = transcript.page(limit=2)
+        self.assertEqual([message['sequence'] for message in page], [4, 5])
+        self.assertTrue(has_more)
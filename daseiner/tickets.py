@@ -0,0 +1,52 @@
+from django.core import signing
+from django.core.cache import cache
+
+ROOM_TICKET_SALT = 'daseiner.room-ticket'
+# Signed values are urlsafe base64 and can contain '--', so tickets carry a
+# prefix that legacy 'room--user' codes never start with.
+TICKET_PREFIX = 'rt.'
+TERMINATION_FLAG_TIMEOUT = 24 * 60 * 60
+
+PARTICIPANT = 'participant'
+JUDGE = 'judge'
+
+
+def make_ticket(room_id, role, user_id, activated_date):
+    return TICKET_PREFIX + signing.dumps(
+        {'roomId': str(room_id), 'role': role, 'userId': user_id, 'activatedDate': activated_date},
+        salt=ROOM_TICKET_SALT,
+        compress=True
+    )
+
+def is_ticket(code):
+    return code.startswith(TICKET_PREFIX)
+
+def read_ticket(ticket, user_id):
+    if not is_ticket(ticket):
+        return None
+    try:
+        payload = signing.loads(ticket[len(TICKET_PREFIX):], salt=ROOM_TICKET_SALT)
+    except signing.BadSignature:
+        return None
+    if payload['userId'] != user_id:
+        return None
+    return payload
+
+def room_terminated_key(room_id):
+    return f'room_terminated:{room_id}'
+
+def set_room_terminated(room_id):
+    cache.set(room_terminated_key(room_id), True, TERMINATION_FLAG_TIMEOUT)
+
+def is_room_terminated(room_id):
+    terminated = cache.get(room_terminated_key(room_id))
+    if terminated is None:
+        from .models import Room
+
+        room = Room.objects.filter(pk=room_id).values('termination_date').first()
+        terminated = room is None or room['termination_date'] is not None
+        # add, not set: a termination flagged while we read must not be
+        # overwritten by the stale row we loaded.
+        if not cache.add(room_terminated_key(room_id), terminated, TERMINATION_FLAG_TIMEOUT):
+            terminated = cache.get(room_terminated_key(room_id), terminated)
+    return terminated
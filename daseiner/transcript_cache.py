@@ -0,0 +1,198 @@
+import threading
+from bisect import bisect_left, bisect_right
+from collections import OrderedDict
+from django.conf import settings
+from django.core.cache import cache
+from django.utils.dateparse import parse_datetime
+
+# Rough per-message bookkeeping cost on top of the text itself, used to keep
+# the in-process tier inside TRANSCRIPT_CACHE_MAX_BYTES.
+MESSAGE_OVERHEAD_BYTES = 256
+
+# How far past the shared head hint a reader probes. Appends from different
+# workers can update the hint out of order, so it may trail the real head.
+HEAD_PROBE_WINDOW = 8
+
+
+def message_key(message):
+    return parse_datetime(message['timestamp']), message['id']
+
+def message_size(message):
+    return MESSAGE_OVERHEAD_BYTES + len(message['content']) + len(message['username'])
+
+
+class RoomTranscript:
+    # head is the highest sequence up to which the transcript has no gaps.
+    # Appends from this worker can land past a message another worker wrote;
+    # the next get fetches everything after head from the shared tier.
+
+    def __init__(self, messages=()):
+        self.keys = []
+        self.messages = []
+        self.sequences = set()
+        self.head = 0
+        self.size = 0
+        for message in messages:
+            self.add(message)
+        # A transcript loaded from the database is complete as of the load.
+        self.head = max(self.sequences, default=0)
+
+    def add(self, message):
+        if message['sequence'] in self.sequences:
+            return 0
+        key = message_key(message)
+        index = bisect_left(self.keys, key)
+        self.keys.insert(index, key)
+        self.messages.insert(index, message)
+        self.sequences.add(message['sequence'])
+        while self.head + 1 in self.sequences:
+            self.head += 1
+        size = message_size(message)
+        self.size += size
+        return size
+
+    def page(self, before=None, after=None, limit=None):
+        if isinstance(before, int) or isinstance(after, int):
+            return self.page_by_sequence(before, after, limit)
+        start, end = 0, len(self.keys)
+        if before:
+            end = bisect_left(self.keys, before)
+        if after:
+            start = bisect_right(self.keys, after)
+            page = self.messages[start:end]
+            return page[:limit], len(page) > limit
+        start = max(start, end - limit)
+        return self.messages[start:end], start > 0
+
+    def page_by_sequence(self, before=None, after=None, limit=None):
+        messages = [message for message in self.since(after or 0) if not before or message['sequence'] < before]
+        if after:
+            return messages[:limit], len(messages) > limit
+        return messages[-limit:], len(messages) > limit
+
+    def since(self, sequence):
+        return sorted(
+            (message for message in self.messages if message['sequence'] > sequence),
+            key=lambda message: message['sequence']
+        )
+
+
+class TranscriptCache:
+    # In-process LRU of serialized room transcripts in front of the Django
+    # cache. The shared tier holds every message under its sequence number
+    # plus a head hint, so a worker can catch up on appends made elsewhere
+    # without touching the database.
+
+    def __init__(self, max_bytes=None, timeout=None):
+        self.max_bytes = max_bytes
+        self.timeout = timeout
+        self.rooms = OrderedDict()
+        self.size = 0
+        self.lock = threading.Lock()
+
+    def get_max_bytes(self):
+        return self.max_bytes or settings.TRANSCRIPT_CACHE_MAX_BYTES
+
+    def get_timeout(self):
+        return self.timeout or settings.TRANSCRIPT_CACHE_TIMEOUT
+
+    def head_key(self, stream, room_id):
+        return f'transcript:{stream}:{room_id}:head'
+
+    def message_cache_key(self, stream, room_id, sequence):
+        return f'transcript:{stream}:{room_id}:{sequence}'
+
+    def get(self, stream, room_id):
+        room_key = (stream, str(room_id))
+        head_key = self.head_key(stream, room_id)
+        with self.lock:
+            entry = self.rooms.get(room_key)
+        # A worker already holding the room asks for the head hint and the
+        # messages just past its own head in one round trip; unless it fell
+        # behind by more than the probe window that is all it needs.
+        first_missing = entry.head + 1 if entry is not None else 1
+        probed = entry.head + HEAD_PROBE_WINDOW if entry is not None else 0
+        keys = [self.message_cache_key(stream, room_id, sequence) for sequence in range(first_missing, probed + 1)]
+        found = cache.get_many([head_key, *keys])
+        head = found.get(head_key)
+        if head is None:
+            if entry is not None:
+                self.evict(room_key)
+            return None
+
+        if head + HEAD_PROBE_WINDOW > probed:
+            behind = [self.message_cache_key(stream, room_id, sequence)
+                      for sequence in range(probed + 1, head + HEAD_PROBE_WINDOW + 1)]
+            found.update(cache.get_many(behind))
+            keys.extend(behind)
+        contiguous = []
+        for key in keys:
+            if key not in found:
+                break
+            contiguous.append(found[key])
+        if first_missing + len(contiguous) - 1 < head:
+            if entry is not None:
+                self.evict(room_key)
+            return None
+
+        with self.lock:
+            if entry is None:
+                entry = RoomTranscript()
+                self.rooms[room_key] = entry
+            for message in contiguous:
+                self.size += entry.add(message)
+            self.rooms.move_to_end(room_key)
+            self.trim()
+        return entry
+
+    def fill(self, stream, room_id, messages):
+        room_key = (stream, str(room_id))
+        entry = RoomTranscript(messages)
+        shared = {self.message_cache_key(stream, room_id, message['sequence']): message for message in messages}
+        shared[self.head_key(stream, room_id)] = entry.head
+        cache.set_many(shared, self.get_timeout())
+        with self.lock:
+            previous = self.rooms.pop(room_key, None)
+            if previous is not None:
+                self.size -= previous.size
+            self.rooms[room_key] = entry
+            self.size += entry.size
+            self.trim()
+        return entry
+
+    def append(self, stream, room_id, message):
+        # Rooms nobody has read yet are left cold; the first read fills them.
+        if cache.get(self.head_key(stream, room_id)) is None:
+            return
+        cache.set_many(
+            {
+                self.message_cache_key(stream, room_id, message['sequence']): message,
+                self.head_key(stream, room_id): message['sequence']
+            },
+            self.get_timeout()
+        )
+        with self.lock:
+            entry = self.rooms.get((stream, str(room_id)))
+            if entry is not None:
+                self.size += entry.add(message)
+                self.trim()
+
+    def invalidate(self, room_id, streams=('participant', 'judge')):
+        cache.delete_many([self.head_key(stream, room_id) for stream in streams])
+        for stream in streams:
+            self.evict((stream, str(room_id)))
+
+    def evict(self, room_key):
+        with self.lock:
+            entry = self.rooms.pop(room_key, None)
+            if entry is not None:
+                self.size -= entry.size
+
+    def trim(self):
+        max_bytes = self.get_max_bytes()
+        while self.size > max_bytes and len(self.rooms) > 1:
+            _, entry = self.rooms.popitem(last=False)
+            self.size -= entry.size
+
+
+transcript_cache = TranscriptCache()
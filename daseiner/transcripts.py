@@ -0,0 +1,158 @@
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Q
+from django.utils.dateparse import parse_datetime
+from .models import ParticipantMessage, JudgeMessage
+from .transcript_cache import transcript_cache
+from .message_buffer import message_buffer
+import uuid
+
+
+class InvalidCursor(ValueError):
+    pass
+
+def parse_cursor(cursor):
+    # Messages broadcast before write-behind has stored them carry no id, so
+    # a cursor is either a (create_date, id) pair or a bare sequence number.
+    if not cursor:
+        return None
+    try:
+        if cursor.get('id') is not None:
+            created = parse_datetime(cursor['timestamp'])
+            if created is None:
+                raise InvalidCursor(cursor)
+            return created, int(cursor['id'])
+        if cursor.get('sequence') is not None:
+            return int(cursor['sequence'])
+    except (AttributeError, KeyError, TypeError, ValueError):
+        raise InvalidCursor(cursor)
+    raise InvalidCursor(cursor)
+
+def page_size(data):
+    # The limit comes straight off the socket; anything that isn't a number
+    # gets the default page rather than failing the fetch.
+    try:
+        limit = int(data.get('limit') or settings.TRANSCRIPT_PAGE_SIZE)
+    except (TypeError, ValueError, OverflowError):
+        limit = settings.TRANSCRIPT_PAGE_SIZE
+    return max(1, min(limit, settings.TRANSCRIPT_MAX_PAGE_SIZE))
+
+def paginate_messages(messages, before=None, after=None, limit=None):
+    # Cursors are (create_date, id) pairs so messages saved within the same
+    # timestamp still page deterministically, or sequence numbers, which page
+    # in sequence order. Pages are returned oldest first.
+    limit = limit or settings.TRANSCRIPT_PAGE_SIZE
+    ordering = ('sequence',) if by_sequence(before, after) else ('create_date', 'id')
+    if before:
+        messages = messages.filter(cursor_filter(before, 'lt'))
+    if after:
+        messages = messages.filter(cursor_filter(after, 'gt'))
+        page = list(messages.order_by(*ordering)[:limit + 1])
+        return page[:limit], len(page) > limit
+
+    page = list(messages.order_by(*('-' + field for field in ordering))[:limit + 1])
+    has_more = len(page) > limit
+    return list(reversed(page[:limit])), has_more
+
+def by_sequence(before, after):
+    kinds = {isinstance(cursor, int) for cursor in (before, after) if cursor}
+    if len(kinds) > 1:
+        raise InvalidCursor((before, after))
+    return kinds == {True}
+
+def cursor_filter(cursor, lookup):
+    if isinstance(cursor, int):
+        return Q(**{f'sequence__{lookup}': cursor})
+    created, pk = cursor
+    return Q(**{f'create_date__{lookup}': created}) | Q(create_date=created, **{f'id__{lookup}': pk})
+
+def message_to_json(message, user):
+    return {
+        'id': message.id,
+        'username': user.username,
+        'content': message.body,
+        'timestamp': str(message.create_date),
+        'userid': user.id,
+        'sequence': message.sequence
+    }
+
+
+class TranscriptLoader:
+    # Projects the author's username and id through the connection join so a
+    # page of messages is always a single query, however long the room is.
+    # With TRANSCRIPT_CACHE_ENABLED the first read of a room loads it whole
+    # into the transcript cache and later reads are served from there.
+
+    def __init__(self, message_model, connection_field, stream):
+        self.message_model = message_model
+        self.connection_field = connection_field
+        self.stream = stream
+        self.username_field = f'{connection_field}__user__username'
+        self.userid_field = f'{connection_field}__user_id'
+
+    def rows(self, room_id):
+        return self.message_model.objects.filter(room=room_id).values(
+            'id', 'body', 'create_date', 'sequence', self.username_field, self.userid_field)
+
+    def row_to_json(self, row):
+        return {
+            'id': row['id'],
+            'username': row[self.username_field],
+            'content': row['body'],
+            'timestamp': str(row['create_date']),
+            'userid': row[self.userid_field],
+            'sequence': row['sequence']
+        }
+
+    def load_transcript(self, room_id):
+        transcript = transcript_cache.get(self.stream, room_id)
+        if transcript is None:
+            transcript = transcript_cache.fill(self.stream, room_id, self.load_all_from_db(room_id))
+        return transcript
+
+    def load_page(self, room_id, before=None, after=None, limit=None):
+        room_id = uuid.UUID(str(room_id))
+        limit = limit or settings.TRANSCRIPT_PAGE_SIZE
+        by_sequence(before, after)
+        if settings.TRANSCRIPT_CACHE_ENABLED:
+            return self.load_transcript(room_id).page(before=before, after=after, limit=limit)
+        page, has_more = paginate_messages(self.rows(room_id), before=before, after=after, limit=limit)
+        return [self.row_to_json(row) for row in page], has_more
+
+    def load_since(self, room_id, sequence):
+        room_id = uuid.UUID(str(room_id))
+        if settings.TRANSCRIPT_CACHE_ENABLED:
+            return self.load_transcript(room_id).since(sequence)
+        rows = self.rows(room_id).filter(sequence__gt=sequence).order_by('sequence')
+        return [self.row_to_json(row) for row in rows]
+
+    def load_all(self, room_id):
+        room_id = uuid.UUID(str(room_id))
+        if settings.TRANSCRIPT_CACHE_ENABLED:
+            return list(self.load_transcript(room_id).messages)
+        return self.load_all_from_db(room_id)
+
+    def load_all_from_db(self, room_id):
+        return [self.row_to_json(row) for row in self.rows(room_id).order_by('create_date', 'id')]
+
+    def append(self, room_id, message):
+        if settings.TRANSCRIPT_CACHE_ENABLED:
+            transcript_cache.append(self.stream, uuid.UUID(str(room_id)), message)
+
+    def save(self, message, user):
+        # With MESSAGE_WRITE_BEHIND the returned message has no id yet, so
+        # clients page from it by sequence; it is queued for writing once the
+        # caller's transaction commits and reaches the transcript cache after.
+        if settings.MESSAGE_WRITE_BEHIND:
+            message.assign_sequence(write_behind=True)
+            formatted_message = message_to_json(message, user)
+            message_buffer.add(message, self, formatted_message)
+            return formatted_message
+        message.save()
+        formatted_message = message_to_json(message, user)
+        transaction.on_commit(lambda: self.append(message.room_id, formatted_message))
+        return formatted_message
+
+
+participant_transcript = TranscriptLoader(ParticipantMessage, 'participant_connection', 'participant')
+judge_transcript = TranscriptLoader(JudgeMessage, 'judge_connection', 'judge')
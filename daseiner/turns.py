@@ -0,0 +1,77 @@
+from django.core.cache import cache
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
+from .models import ParticipantConnection
+
+TURN_LENGTH_SECONDS = 120
+TURN_CHANGES = 7
+SCHEDULE_TIMEOUT = 60 * 60
+
+
+def turn_schedule_key(room_id):
+    return f'turn_schedule:{room_id}'
+
+
+class TurnSchedule:
+    # Turns are a pure function of when the room was activated: the
+    # participant who connected first speaks on even turns, the other on odd
+    # turns, and the speaker stops changing after TURN_CHANGES switches.
+
+    def __init__(self, activated_date, first_speaker_id, second_speaker_id):
+        self.activated_date = activated_date
+        self.first_speaker_id = first_speaker_id
+        self.second_speaker_id = second_speaker_id
+
+    def turn(self, now=None):
+        elapsed = ((now or timezone.now()) - self.activated_date).total_seconds()
+        return min(max(int(elapsed // TURN_LENGTH_SECONDS), 0), TURN_CHANGES)
+
+    def current_speaker_id(self, now=None):
+        return self.first_speaker_id if self.turn(now) % 2 == 0 else self.second_speaker_id
+
+    def seconds_until_next_turn(self, now=None):
+        now = now or timezone.now()
+        turn = self.turn(now)
+        if turn == TURN_CHANGES:
+            return None
+        elapsed = (now - self.activated_date).total_seconds()
+        return max((turn + 1) * TURN_LENGTH_SECONDS - elapsed, 0)
+
+    def remaining_turns(self, now=None):
+        return TURN_CHANGES - self.turn(now)
+
+    def is_participant(self, user_id):
+        return user_id in (self.first_speaker_id, self.second_speaker_id)
+
+    def to_json(self, user_id=None, now=None):
+        now = now or timezone.now()
+        speaker_id = self.current_speaker_id(now)
+        turn_state = {
+            'turn': self.turn(now),
+            'speakerId': speaker_id,
+            'secondsUntilNextTurn': self.seconds_until_next_turn(now),
+            'remainingTurns': self.remaining_turns(now)
+        }
+        if user_id is not None:
+            turn_state['isUsersTurn'] = speaker_id == user_id
+        return turn_state
+
+
+def get_turn_schedule(room_id):
+    cached = cache.get(turn_schedule_key(room_id))
+    if cached is not None:
+        return TurnSchedule(parse_datetime(cached[0]), cached[1], cached[2])
+
+    connections = list(
+        ParticipantConnection.objects.filter(room=room_id).order_by('create_date', 'id').values_list(
+            'user_id', 'room__activated_date')
+    )
+    if len(connections) != 2 or not connections[0][1]:
+        return None
+    activated_date = connections[0][1]
+    cache.set(
+        turn_schedule_key(room_id),
+        (activated_date.isoformat(), connections[0][0], connections[1][0]),
+        SCHEDULE_TIMEOUT
+    )
+    return TurnSchedule(activated_date, connections[0][0], connections[1][0])
@@ -11,6 +11,8 @@ urlpatterns = [
     path(r'api/chat-turn/<str:room_id>', views.ChatTurnView.as_view()),
     path(r'api/question/<str:room_id>', views.QuestionView.as_view()),
     path(r'api/check-current-matches/', views.CheckForMatchView.as_view()),
+    path(r'api/debug/command-stats/', views.CommandStatsView.as_view()),
+    path(r'api/metrics', views.MetricsView.as_view()),
     path('activate/<uidb64>/<token>/', views.ActivateAccount.as_view(), name='activate'),
 ]
 urlpatterns += router.urls
@@ -12,6 +12,16 @@ from django.utils.http import urlsafe_base64_decode
 from django.http import HttpResponseRedirect
 from rest_framework.exceptions import ValidationError
 from django.conf import settings
+from django.core.cache import cache
+from .questions import question_deck, room_question_key, ROOM_QUESTION_TIMEOUT
+from .turns import get_turn_schedule
+from . import session_state
+from . import tickets
+from .instrumentation import command_stats
+from . import metrics
+from django.http import HttpResponse
+from django.utils.dateparse import parse_datetime
+import hmac
 
 class UserViewSet(viewsets.GenericViewSet, mixins.CreateModelMixin):
     queryset = User.objects.all()
@@ -22,6 +32,8 @@ class RoomValidationView(views.APIView):
     permission_classes = (permissions.IsAuthenticated,)
     
     def get(self, request, room_code):
+        if tickets.is_ticket(room_code):
+            return self.validate_ticket(request, room_code)
         room_is_valid = False
         activated_date = None
         try:
@@ -44,6 +56,15 @@ class RoomValidationView(views.APIView):
         finally:
             return Response({"isValid": room_is_valid, "activatedDate": activated_date})
 
+    def validate_ticket(self, request, ticket):
+        payload = tickets.read_ticket(ticket, request.user.id)
+        if payload is None:
+            return Response({"isValid": False, "activatedDate": None})
+        return Response({
+            "isValid": not tickets.is_room_terminated(payload['roomId']),
+            "activatedDate": parse_datetime(payload['activatedDate'])
+        })
+
 class UserSettingsView(views.APIView):
     permission_classes = (permissions.IsAuthenticated,)
 
@@ -90,79 +111,64 @@ class ChatTurnView(views.APIView):
 
     def get(self, request, room_id):
         try:
-            users_turn = None
             user_id = request.user.id
-            user_connection = ParticipantConnection.objects.get(user=user_id, room=room_id)
-            users_turn = user_connection.is_current_speaker
-            return Response({"isUsersTurn": users_turn})
+            schedule = get_turn_schedule(room_id)
         except:
             raise ValidationError
+        if schedule is None or not schedule.is_participant(user_id):
+            raise ValidationError
+        return Response(schedule.to_json(user_id))
 
 class QuestionView(views.APIView):
     permission_classes = (permissions.IsAuthenticated,)
 
     def get(self, request, room_id):
-            room = Room.objects.get(id=room_id)
-            question_title = room.question.title
+            question_id = cache.get(room_question_key(room_id))
+            if question_id is None:
+                question_id = Room.objects.values_list('question_id', flat=True).get(id=room_id)
+                cache.set(room_question_key(room_id), question_id, ROOM_QUESTION_TIMEOUT)
+            question_title = question_deck.title(question_id)
             return Response({"question":question_title})
 
 class CheckForMatchView(views.APIView):
     permission_classes = (permissions.IsAuthenticated,)
 
     def get(self, request):
-        room_info = {}
-        has_match = False
-        is_queued = False
-        user = User.objects.get(pk=request.user.id)
-
-        waiting_judge = WaitingJudge.objects.filter(user=user)
-        queued_as_judge = waiting_judge.count() != 0
-        participant = ParticipantConnection.objects.filter(user=user,room__is_open=True)
-        queued_as_participant = participant.count() != 0
-
-        if queued_as_judge:
-            is_queued = True
-            room_info['userType'] = 'judge'
-        elif queued_as_participant:
-            is_queued = True
-            room_info['userType'] = 'participant'
-        
-        if not is_queued:
-            judge_connection = JudgeConnection.objects.filter(
-                user=user, 
-                room__termination_date=None,
-                room__is_open=False
-            )
-
-            if not judge_connection.count():
-                participant_connection = ParticipantConnection.objects.filter(
-                    user=user, 
-                    room__termination_date=None,
-                    room__is_open=False
-                )
-
-                if not participant_connection.count():
-                    room_info = None
-                else:
-                    room_id = participant_connection[0].room.id
-                    room = Room.objects.get(pk=room_id)
-                    has_match = True
-                    room_info['userType'] = 'participant'
-                    room_info['activatedDate'] = room.activated_date
-                    room_info['roomId'] = room.id
-            else:
-                room_id = judge_connection[0].room.id
-                room = Room.objects.get(pk=room_id)
-                has_match = True
-                room_info['userType'] = 'judge'
-                room_info['activatedDate'] = room.activated_date
-                room_info['roomId'] = room.id
-
+        state = session_state.get_state(request.user.id)
+        room_info = None
+        if state['state'] != session_state.IDLE:
+            room_info = {'userType': state['role']}
+        if state['state'] == session_state.IN_ROOM:
+            room_info['activatedDate'] = state['activatedDate']
+            room_info['roomId'] = state['roomId']
 
         return Response(
             {
                 "roomInfo": room_info,
-                "hasActiveMatch": has_match,
-                "isQueued":is_queued
+                "hasActiveMatch": state['state'] == session_state.IN_ROOM,
+                "isQueued": state['state'] == session_state.QUEUED
             }
         )
+
+class CommandStatsView(views.APIView):
+    permission_classes = (permissions.IsAdminUser,)
+
+    def get(self, request):
+        return Response({"worker": command_stats.worker_id, "commands": command_stats.snapshot()})
+
+class MetricsScrapePermission(permissions.BasePermission):
+    # Scrapers send METRICS_SCRAPE_TOKEN as a bearer token or connect from an
+    # address in METRICS_ALLOWED_IPS; with neither configured nobody gets in.
+    def has_permission(self, request, view):
+        token = settings.METRICS_SCRAPE_TOKEN
+        authorization = request.META.get('HTTP_AUTHORIZATION', '')
+        if token and hmac.compare_digest(authorization.encode(), f'Bearer {token}'.encode()):
+            return True
+        return request.META.get('REMOTE_ADDR') in settings.METRICS_ALLOWED_IPS
+
+class MetricsView(views.APIView):
+    authentication_classes = ()
+    permission_classes = (MetricsScrapePermission,)
+
+    def get(self, request):
+        return HttpResponse(metrics.render(), content_type='text/plain; version=0.0.4; charset=utf-8')
@@ -24,7 +24,9 @@ from channels.routing import get_default_application
 
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'daseiner_proj.settings')
 
-os.environ['ASGI_THREADS']="4"
+# Database work runs on the executors in daseiner.instrumentation, sized by
+# DB_EXECUTOR_THREADS; this only bounds the default pool for other sync code.
+os.environ.setdefault('ASGI_THREADS', "4")
 
 django.setup()
 application = get_default_application()
\ No newline at end of file
@@ -26,6 +26,37 @@ REDIRECT_URL = get_config('REDIRECT_URL')
 ADMIN_PATH = get_config('ADMIN_PATH')
 ALLOWED_HOSTS = get_config("ALLOWED_HOSTS")
 
+# Old clients expect every new_message frame to carry the room's whole transcript.
+CHAT_FULL_HISTORY_BROADCAST = configs.get('CHAT_FULL_HISTORY_BROADCAST', False)
+
+TRANSCRIPT_PAGE_SIZE = configs.get('TRANSCRIPT_PAGE_SIZE', 50)
+TRANSCRIPT_MAX_PAGE_SIZE = configs.get('TRANSCRIPT_MAX_PAGE_SIZE', 200)
+
+TRANSCRIPT_CACHE_ENABLED = configs.get('TRANSCRIPT_CACHE_ENABLED', True)
+TRANSCRIPT_CACHE_MAX_BYTES = configs.get('TRANSCRIPT_CACHE_MAX_BYTES', 32 * 1024 * 1024)
+TRANSCRIPT_CACHE_TIMEOUT = configs.get('TRANSCRIPT_CACHE_TIMEOUT', 6 * 60 * 60)
+
+# Broadcast chat messages before they are written and insert them in batches
+# from a per-worker buffer, flushed every MESSAGE_FLUSH_INTERVAL seconds or
+# MESSAGE_BATCH_SIZE messages.
+MESSAGE_WRITE_BEHIND = configs.get('MESSAGE_WRITE_BEHIND', False)
+MESSAGE_BUFFER_MAX_SIZE = configs.get('MESSAGE_BUFFER_MAX_SIZE', 5000)
+MESSAGE_BATCH_SIZE = configs.get('MESSAGE_BATCH_SIZE', 200)
+MESSAGE_FLUSH_INTERVAL = configs.get('MESSAGE_FLUSH_INTERVAL', 0.005)
+
+# Websocket handshakes reuse verified token claims (never past the token's own
+# expiry) and recently loaded users.
+WEBSOCKET_TOKEN_CACHE_SIZE = configs.get('WEBSOCKET_TOKEN_CACHE_SIZE', 10000)
+WEBSOCKET_TOKEN_CACHE_TTL = configs.get('WEBSOCKET_TOKEN_CACHE_TTL', 5 * 60)
+WEBSOCKET_USER_CACHE_SIZE = configs.get('WEBSOCKET_USER_CACHE_SIZE', 10000)
+WEBSOCKET_USER_CACHE_TTL = configs.get('WEBSOCKET_USER_CACHE_TTL', 60)
+
+# DatabaseSeatQueue pairs through row locks on the room table and a Postgres
+# advisory lock for opening rooms; RedisSeatQueue keeps open seats in a Redis
+# list shared by every daphne worker, claimed and filled by Lua scripts.
+MATCHMAKING_QUEUE = configs.get('MATCHMAKING_QUEUE', 'daseiner.matchmaking.DatabaseSeatQueue')
+MATCHMAKING_REDIS_URL = os.environ.get('REDIS_URL', 'redis://localhost:6379')
+
 
 INSTALLED_APPS =[
     'channels',
@@ -91,6 +122,10 @@ WSGI_APPLICATION = 'daseiner_proj.wsgi.application'
 ASGI_APPLICATION = 'daseiner_proj.routing.application'
 
 
+# Keep database connections open across websocket commands instead of
+# reconnecting on every executor hop.
+DATABASE_CONN_MAX_AGE = configs.get('DATABASE_CONN_MAX_AGE', 60)
+
 if get_config('DEBUG'):
     DATABASES = get_config('DATABASES')
     BROKER_URL = 'redis://localhost:6379'
@@ -105,7 +140,7 @@ if get_config('DEBUG'):
     }
 else:
     DATABASES = get_config("DATABASES")
-    DATABASES['default'] = dj_database_url.config()
+    DATABASES['default'] = dj_database_url.config(conn_max_age=DATABASE_CONN_MAX_AGE)
     BROKER_URL=os.environ['REDIS_URL']
     CELERY_RESULT_BACKEND=os.environ['REDIS_URL']    
     CHANNEL_LAYERS = {
@@ -124,6 +159,45 @@ else:
         }
     }
 
+# Spread rooms over several Redis instances, given as {"name": "redis://..."}.
+# Shard names must be letters, digits or underscores.
+CHANNEL_LAYER_SHARDS = configs.get('CHANNEL_LAYER_SHARDS')
+if CHANNEL_LAYER_SHARDS:
+    CHANNEL_LAYERS = {
+        'default': {
+            'BACKEND': 'daseiner.channel_layers.ShardedChannelLayer',
+            'CONFIG': {
+                'shards': {
+                    name: {'BACKEND': 'channels_redis.core.RedisChannelLayer', 'CONFIG': {'hosts': [url]}}
+                    for name, url in CHANNEL_LAYER_SHARDS.items()
+                },
+            },
+        },
+    }
+
+# Deliver group events to members on the same process directly and publish
+# once per process to the configured layer for the rest.
+if configs.get('CHANNEL_LAYER_LOCAL_FAST_PATH', False):
+    CHANNEL_LAYERS = {
+        'default': {
+            'BACKEND': 'daseiner.channel_layers.HybridChannelLayer',
+            'CONFIG': {'remote': CHANNEL_LAYERS['default']},
+        },
+    }
+
+for database in DATABASES.values():
+    database.setdefault('CONN_MAX_AGE', DATABASE_CONN_MAX_AGE)
+
+# Consumers run their database work on dedicated thread pools; websocket auth
+# lookups get a lane of their own. Idle connections are pinged before reuse.
+DB_EXECUTOR_THREADS = configs.get('DB_EXECUTOR_THREADS', 8)
+DB_AUTH_EXECUTOR_THREADS = configs.get('DB_AUTH_EXECUTOR_THREADS', 2)
+DB_HEALTH_CHECK_INTERVAL = configs.get('DB_HEALTH_CHECK_INTERVAL', 30)
+
+# Prometheus scrapes /api/metrics with METRICS_SCRAPE_TOKEN as a bearer token
+# or from one of METRICS_ALLOWED_IPS.
+METRICS_SCRAPE_TOKEN = configs.get('METRICS_SCRAPE_TOKEN')
+METRICS_ALLOWED_IPS = configs.get('METRICS_ALLOWED_IPS', [])
 
 
 AUTH_PASSWORD_VALIDATORS = [
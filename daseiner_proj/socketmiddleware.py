@@ -1,11 +1,100 @@
-from django.db import close_old_connections
 from rest_framework_simplejwt.tokens import UntypedToken
 from rest_framework_simplejwt.exceptions import InvalidToken, TokenError
-from jwt import decode as jwt_decode
 from django.conf import settings
-from django.contrib.auth.models import User
+from django.contrib.auth.models import User, AnonymousUser
+from django.core.cache import cache
 from urllib.parse import parse_qs
-from channels.db import database_sync_to_async
+from daseiner.instrumentation import database_sync_to_async
+from collections import OrderedDict
+import threading
+import time
+
+
+class TTLCache:
+    """
+    Bounded LRU whose entries also expire after a ttl or an explicit deadline
+    """
+
+    def __init__(self, max_entries, ttl):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                return None
+            value, expires_at = entry
+            if expires_at <= time.time():
+                del self.entries[key]
+                return None
+            self.entries.move_to_end(key)
+            return value
+
+    def set(self, key, value, expires_at=None):
+        deadline = time.time() + self.ttl
+        if expires_at is not None:
+            deadline = min(deadline, expires_at)
+        with self.lock:
+            self.entries[key] = (value, deadline)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+    def delete(self, key):
+        with self.lock:
+            self.entries.pop(key, None)
+
+
+token_claims_cache = TTLCache(settings.WEBSOCKET_TOKEN_CACHE_SIZE, settings.WEBSOCKET_TOKEN_CACHE_TTL)
+user_cache = TTLCache(settings.WEBSOCKET_USER_CACHE_SIZE, settings.WEBSOCKET_USER_CACHE_TTL)
+
+
+def user_revoked_key(user_id):
+    return f'websocket_user_revoked:{user_id}'
+
+def invalidate_user(user_id):
+    # Other workers see the marker and go back to the database for this user
+    # until their own cached copy would have expired anyway.
+    user_cache.delete(user_id)
+    cache.set(user_revoked_key(user_id), True, settings.WEBSOCKET_USER_CACHE_TTL)
+
+def verify_token(token):
+    claims = token_claims_cache.get(token)
+    if claims is None:
+        try:
+            claims = UntypedToken(token).payload
+        except (InvalidToken, TokenError):
+            return None
+        token_claims_cache.set(token, claims, expires_at=claims.get('exp'))
+    return claims
+
+def load_user(user_id):
+    user = User.objects.filter(id=user_id, is_active=True).first()
+    if user is not None:
+        user_cache.set(user_id, user)
+    return user
+
+def check_user(user_id, user):
+    # The revocation marker lives in the shared cache, which is network I/O,
+    # so it is read on the auth lane together with any reload it triggers.
+    if cache.get(user_revoked_key(user_id)):
+        return load_user(user_id)
+    return user
+
+async def get_user(token):
+    claims = verify_token(token) if token else None
+    if claims is None:
+        return AnonymousUser()
+    user_id = claims['user_id']
+    user = user_cache.get(user_id)
+    if user is None:
+        user = await database_sync_to_async(load_user, lane='auth')(user_id)
+    else:
+        user = await database_sync_to_async(check_user, lane='auth')(user_id, user)
+    return user or AnonymousUser()
 
 
 class TokenAuthMiddleware:
@@ -18,20 +107,8 @@ class TokenAuthMiddleware:
         self.inner = inner
 
     def __call__(self, scope):
-        user = None
-        database_sync_to_async(close_old_connections)()
         parsed_qs = parse_qs(scope["query_string"].decode("utf8"))
-        if parsed_qs:
-            token = parsed_qs["token"][0]
-            try:
-                UntypedToken(token)
-            except (InvalidToken, TokenError) as e:
-                return self.inner(dict(scope, user=user))
-            else:
-                decoded_data = jwt_decode(token, settings.SECRET_KEY, algorithms=["HS256"])
-                user =  database_sync_to_async(User.objects.get)(
-                    id=decoded_data["user_id"]
-                )
-        return self.inner(dict(scope, user=user))
-
-TokenAuthMiddlewareStack = lambda inner: TokenAuthMiddleware(TokenAuthMiddleware(inner))
+        token = parsed_qs["token"][0] if parsed_qs.get("token") else None
+        return self.inner(dict(scope, user=get_user(token)))
+
+TokenAuthMiddlewareStack = lambda inner: TokenAuthMiddleware(inner)